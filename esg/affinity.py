@@ -0,0 +1,83 @@
+"""
+Placement of worker processes on CPUs.
+
+The `cpu_affinity` setting is one of:
+
+* "auto" - Each worker is pinned to a single CPU, in NUMA node order.
+* "numa" - Each worker is pinned to all the CPUs of a NUMA node, the workers
+           are spread over the nodes round-robin.
+* A list of CPUs per worker, separated by ";", e.g. "0-3;4-7". Each list
+  uses the kernel's cpulist format, e.g. "0,2,4-6". Lists are reused
+  round-robin when there are more workers than lists.
+"""
+import os
+from pathlib import Path
+from typing import List, Set
+
+NODE_PATH = Path("/sys/devices/system/node")
+
+
+def supports_affinity() -> bool:
+    return hasattr(os, "sched_setaffinity")
+
+
+def parse_cpu_list(value: str) -> Set[int]:
+    cpus: Set[int] = set()
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def get_numa_nodes(path: Path = NODE_PATH) -> List[Set[int]]:
+    """
+    The CPUs of each NUMA node, empty when the system does not expose them.
+    """
+    nodes = []
+    for node in sorted(path.glob("node[0-9]*"), key=lambda node: int(node.name[4:])):
+        try:
+            cpus = parse_cpu_list((node / "cpulist").read_text())
+        except OSError:
+            continue
+        if cpus:
+            nodes.append(cpus)
+    return nodes
+
+
+def get_worker_cpus(
+    spec: str, workers: int, available: Set[int], nodes: List[Set[int]]
+) -> List[Set[int]]:
+    """
+    The CPUs each worker gets pinned to, restricted to the `available` ones.
+    """
+    if spec in ("auto", "numa"):
+        nodes = [node & available for node in nodes]
+        nodes = [node for node in nodes if node]
+        if not nodes:
+            nodes = [set(available)]
+        if spec == "numa":
+            return [nodes[idx % len(nodes)] for idx in range(workers)]
+        cpus = [cpu for node in nodes for cpu in sorted(node)]
+        cpus.extend(sorted(available.difference(cpus)))
+        return [{cpus[idx % len(cpus)]} for idx in range(workers)]
+
+    try:
+        lists = [parse_cpu_list(value) for value in spec.split(";") if value.strip()]
+    except ValueError:
+        raise ValueError(f"Invalid cpu_affinity: {spec!r}") from None
+    for cpus in lists:
+        if not cpus or not cpus <= available:
+            raise ValueError(f"Invalid CPU list in cpu_affinity: {spec!r}")
+    if not lists:
+        raise ValueError(f"Invalid cpu_affinity: {spec!r}")
+    return [lists[idx % len(lists)] for idx in range(workers)]
+
+
+def worker_cpus(spec: str, workers: int) -> List[Set[int]]:
+    return get_worker_cpus(spec, workers, os.sched_getaffinity(0), get_numa_nodes())
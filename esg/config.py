@@ -3,6 +3,7 @@ import inspect
 import json
 import logging
 import logging.config
+import multiprocessing
 import os
 import socket
 import ssl
@@ -28,14 +29,16 @@ except ImportError:
     # enable this functionality.
     pass
 
+from esg.affinity import supports_affinity, worker_cpus
 from esg.importer import ImportFromStringError, import_from_string
 from esg.middleware.asgi2 import ASGI2Middleware
 from esg.middleware.debug import DebugMiddleware
 from esg.middleware.message_logger import MessageLoggerMiddleware
 from esg.middleware.proxy_headers import ProxyHeadersMiddleware
 from esg.middleware.wsgi import WSGIMiddleware
+from esg.reuseport import supports_cpu_program, supports_reuse_port
 
-HTTPProtocolType = Literal["auto", "h11", "httptools"]
+HTTPProtocolType = Literal["auto", "llhttp", "buffered"]
 WSProtocolType = Literal["auto", "none", "websockets", "wsproto"]
 LifespanType = Literal["auto", "on", "off"]
 LoopSetupType = Literal["none", "auto", "asyncio", "uvloop"]
@@ -51,8 +54,8 @@ LOG_LEVELS: Dict[str, int] = {
 }
 HTTP_PROTOCOLS: Dict[HTTPProtocolType, str] = {
     "auto": "esg.protocols.http.auto:AutoHTTPProtocol",
-    "h11": "esg.protocols.http.h11_impl:H11Protocol",
-    "httptools": "esg.protocols.http.httptools_impl:HttpToolsProtocol",
+    "llhttp": "esg.protocols.http.protocol:Protocol",
+    "buffered": "esg.protocols.http.protocol:BufferedProtocol",
 }
 WS_PROTOCOLS: Dict[WSProtocolType, Optional[str]] = {
     "auto": "esg.protocols.websockets.auto:AutoWebSocketsProtocol",
@@ -215,12 +218,33 @@ class Config:
         "reload",
         "reload_delay",
         "workers",
+        "reuse_port",
+        "reuse_port_cbpf",
+        "cpu_affinity",
+        "preload",
         "proxy_headers",
         "server_header",
         "date_header",
         "root_path",
         "limit_concurrency",
         "limit_max_requests",
+        "limit_max_requests_jitter",
+        "limit_worker_memory",
+        "timeout_worker_heartbeat",
+        "limit_request_line",
+        "limit_request_headers",
+        "limit_request_header_size",
+        "limit_request_body",
+        "expect_hook",
+        "pipeline_depth",
+        "stream_request_body",
+        "receive_chunk_size",
+        "zero_copy_body",
+        "write_batch_latency",
+        "read_high_water",
+        "write_high_water",
+        "write_low_water",
+        "read_memory_budget",
         "backlog",
         "timeout_keep_alive",
         "timeout_notify",
@@ -242,9 +266,11 @@ class Config:
         "reload_excludes",
         "forwarded_allow_ips",
         "ssl",
+        "http_protocol_class",
         "ws_protocol_class",
         "lifespan_class",
         "loaded_app",
+        "loaded_expect_hook",
     ]
 
     def __init__(
@@ -255,6 +281,7 @@ class Config:
         uds: Optional[str] = None,
         fd: Optional[int] = None,
         loop: LoopSetupType = "auto",
+        http: Union[Type[asyncio.Protocol], HTTPProtocolType] = "auto",
         ws: Union[Type[asyncio.Protocol], WSProtocolType] = "auto",
         ws_max_size: int = 16 * 1024 * 1024,
         ws_ping_interval: Optional[float] = 20,
@@ -273,6 +300,10 @@ class Config:
         reload_includes: Optional[Union[List[str], str]] = None,
         reload_excludes: Optional[Union[List[str], str]] = None,
         workers: Optional[int] = None,
+        reuse_port: bool = False,
+        reuse_port_cbpf: bool = False,
+        cpu_affinity: Optional[str] = None,
+        preload: bool = False,
         proxy_headers: bool = True,
         server_header: bool = True,
         date_header: bool = True,
@@ -280,6 +311,23 @@ class Config:
         root_path: str = "",
         limit_concurrency: Optional[int] = None,
         limit_max_requests: Optional[int] = None,
+        limit_max_requests_jitter: int = 0,
+        limit_worker_memory: Optional[int] = None,
+        timeout_worker_heartbeat: Optional[int] = None,
+        limit_request_line: int = 8190,
+        limit_request_headers: int = 100,
+        limit_request_header_size: int = 8190,
+        limit_request_body: Optional[int] = None,
+        expect_hook: Optional[Union[Callable[..., Optional[int]], str]] = None,
+        pipeline_depth: int = 16,
+        stream_request_body: bool = False,
+        receive_chunk_size: Optional[int] = None,
+        zero_copy_body: bool = False,
+        write_batch_latency: Optional[float] = None,
+        read_high_water: int = 65536,
+        write_high_water: Optional[int] = None,
+        write_low_water: Optional[int] = None,
+        read_memory_budget: Optional[int] = None,
         backlog: int = 2048,
         timeout_keep_alive: int = 5,
         timeout_notify: int = 30,
@@ -300,6 +348,7 @@ class Config:
         self.uds = uds
         self.fd = fd
         self.loop = loop
+        self.http = http
         self.ws = ws
         self.ws_max_size = ws_max_size
         self.ws_ping_interval = ws_ping_interval
@@ -314,12 +363,33 @@ class Config:
         self.reload = reload
         self.reload_delay = reload_delay or 0.25
         self.workers = workers or 1
+        self.reuse_port = reuse_port
+        self.reuse_port_cbpf = reuse_port_cbpf
+        self.cpu_affinity = cpu_affinity
+        self.preload = preload
         self.proxy_headers = proxy_headers
         self.server_header = server_header
         self.date_header = date_header
         self.root_path = root_path
         self.limit_concurrency = limit_concurrency
         self.limit_max_requests = limit_max_requests
+        self.limit_max_requests_jitter = limit_max_requests_jitter
+        self.limit_worker_memory = limit_worker_memory
+        self.timeout_worker_heartbeat = timeout_worker_heartbeat
+        self.limit_request_line = limit_request_line
+        self.limit_request_headers = limit_request_headers
+        self.limit_request_header_size = limit_request_header_size
+        self.limit_request_body = limit_request_body
+        self.expect_hook = expect_hook
+        self.pipeline_depth = pipeline_depth
+        self.stream_request_body = stream_request_body
+        self.receive_chunk_size = receive_chunk_size
+        self.zero_copy_body = zero_copy_body
+        self.write_batch_latency = write_batch_latency
+        self.read_high_water = read_high_water
+        self.write_high_water = write_high_water
+        self.write_low_water = write_low_water
+        self.read_memory_budget = read_memory_budget
         self.backlog = backlog
         self.timeout_keep_alive = timeout_keep_alive
         self.timeout_notify = timeout_notify
@@ -404,6 +474,41 @@ class Config:
         if workers is None and "WEB_CONCURRENCY" in os.environ:
             self.workers = int(os.environ["WEB_CONCURRENCY"])
 
+        if self.reuse_port and (self.uds or self.fd or not supports_reuse_port()):
+            logger.warning(
+                "SO_REUSEPORT is only supported for TCP sockets on this platform, "
+                "'reuse_port' is ignored."
+            )
+            self.reuse_port = False
+
+        if self.reuse_port_cbpf and not (self.reuse_port and supports_cpu_program()):
+            logger.warning(
+                "'reuse_port_cbpf' requires 'reuse_port' on Linux, it is ignored."
+            )
+            self.reuse_port_cbpf = False
+
+        if self.cpu_affinity and not supports_affinity():
+            logger.warning(
+                "CPU affinity is not supported on this platform, it is ignored."
+            )
+            self.cpu_affinity = None
+
+        if self.cpu_affinity:
+            # Reported once here, rather than by every worker.
+            try:
+                worker_cpus(self.cpu_affinity, self.workers)
+            except ValueError as exc:
+                logger.error(exc)
+                sys.exit(1)
+
+        fork = "fork" in multiprocessing.get_all_start_methods()
+        if self.preload and (self.should_reload or not fork):
+            logger.warning(
+                "'preload' requires forking worker processes without reload, "
+                "it is ignored."
+            )
+            self.preload = False
+
         if forwarded_allow_ips is None:
             self.forwarded_allow_ips = os.environ.get(
                 "FORWARDED_ALLOW_IPS", "127.0.0.1"
@@ -491,12 +596,25 @@ class Config:
             else encoded_headers
         )
 
+        if isinstance(self.http, str):
+            http_protocol_class = import_from_string(HTTP_PROTOCOLS[self.http])
+            self.http_protocol_class: Type[asyncio.Protocol] = http_protocol_class
+        else:
+            self.http_protocol_class = self.http
+
         if isinstance(self.ws, str):
             ws_protocol_class = import_from_string(WS_PROTOCOLS[self.ws])
             self.ws_protocol_class: Optional[Type[asyncio.Protocol]] = ws_protocol_class
         else:
             self.ws_protocol_class = self.ws
 
+        if isinstance(self.expect_hook, str):
+            self.loaded_expect_hook: Optional[Callable] = import_from_string(
+                self.expect_hook
+            )
+        else:
+            self.loaded_expect_hook = self.expect_hook
+
         self.lifespan_class = import_from_string(LIFESPAN[self.lifespan])
 
         try:
@@ -592,6 +710,9 @@ class Config:
 
             sock = socket.socket(family=family)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                # Reserves the port, the workers listen on sockets of their own.
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             try:
                 sock.bind((self.host, self.port))
             except OSError as exc:
@@ -9,7 +9,9 @@ import click
 from asgiref.typing import ASGIApplication
 
 import esg
+from esg.affinity import worker_cpus
 from esg.config import (
+    HTTP_PROTOCOLS,
     INTERFACES,
     LIFESPAN,
     LOG_LEVELS,
@@ -23,6 +25,7 @@ from esg.server import Server, ServerState  # noqa: F401  # Used to be defined h
 from esg.supervisors import ChangeReload, Multiprocess
 
 LEVEL_CHOICES = click.Choice(list(LOG_LEVELS.keys()))
+HTTP_CHOICES = click.Choice(list(HTTP_PROTOCOLS.keys()))
 WS_CHOICES = click.Choice(list(WS_PROTOCOLS.keys()))
 LIFESPAN_CHOICES = click.Choice(list(LIFESPAN.keys()))
 LOOP_CHOICES = click.Choice([key for key in LOOP_SETUPS.keys() if key != "none"])
@@ -110,6 +113,35 @@ def print_version(ctx: click.Context, param: click.Parameter, value: bool) -> No
     help="Number of worker processes. Defaults to the $WEB_CONCURRENCY environment"
     " variable if available, or 1. Not valid with --reload.",
 )
+@click.option(
+    "--reuse-port",
+    is_flag=True,
+    default=False,
+    help="Let every worker listen on a SO_REUSEPORT socket of its own, so that"
+    " the kernel balances new connections between them.",
+)
+@click.option(
+    "--reuse-port-cbpf",
+    is_flag=True,
+    default=False,
+    help="With --reuse-port on Linux, hand new connections to workers by the CPU"
+    " that received them.",
+)
+@click.option(
+    "--cpu-affinity",
+    type=str,
+    default=None,
+    help="Pin workers to CPUs. 'auto' pins each worker to a single CPU, 'numa'"
+    " to the CPUs of a NUMA node, or give a list of CPUs per worker separated by"
+    " ';', such as '0-3;4-7'.",
+)
+@click.option(
+    "--preload",
+    is_flag=True,
+    default=False,
+    help="Load the application before forking the workers, so that they share"
+    " its memory. Not valid with --reload.",
+)
 @click.option(
     "--loop",
     type=LOOP_CHOICES,
@@ -117,6 +149,13 @@ def print_version(ctx: click.Context, param: click.Parameter, value: bool) -> No
     help="Event loop implementation.",
     show_default=True,
 )
+@click.option(
+    "--http",
+    type=HTTP_CHOICES,
+    default="auto",
+    help="HTTP protocol implementation.",
+    show_default=True,
+)
 @click.option(
     "--ws",
     type=WS_CHOICES,
@@ -243,6 +282,133 @@ def print_version(ctx: click.Context, param: click.Parameter, value: bool) -> No
     default=None,
     help="Maximum number of requests to service before terminating the process.",
 )
+@click.option(
+    "--limit-max-requests-jitter",
+    type=int,
+    default=0,
+    help="Maximum random number of requests added to --limit-max-requests per"
+    " worker, so that workers don't all restart at once.",
+    show_default=True,
+)
+@click.option(
+    "--limit-worker-memory",
+    type=int,
+    default=None,
+    help="Maximum resident memory of a worker in bytes, before it is gracefully"
+    " replaced. Only with --workers on Linux.",
+)
+@click.option(
+    "--timeout-worker-heartbeat",
+    type=int,
+    default=None,
+    help="Kill and replace a worker whose event loop didn't respond within this"
+    " number of seconds. Only with --workers.",
+)
+@click.option(
+    "--limit-request-line",
+    type=int,
+    default=8190,
+    help="Maximum size of a request URL, before issuing HTTP 414 responses."
+    " Set to 0 for no limit.",
+    show_default=True,
+)
+@click.option(
+    "--limit-request-headers",
+    type=int,
+    default=100,
+    help="Maximum number of request headers, before issuing HTTP 431 responses."
+    " Set to 0 for no limit.",
+    show_default=True,
+)
+@click.option(
+    "--limit-request-header-size",
+    type=int,
+    default=8190,
+    help="Maximum size of a request header, before issuing HTTP 431 responses."
+    " Set to 0 for no limit.",
+    show_default=True,
+)
+@click.option(
+    "--limit-request-body",
+    type=int,
+    default=None,
+    help="Maximum size of a request body in bytes, before issuing HTTP 413"
+    " responses.",
+)
+@click.option(
+    "--expect-hook",
+    type=str,
+    default=None,
+    help="Import string of a callable run with the scope of requests sending"
+    " 'Expect: 100-continue', before the application. It returns None to accept"
+    " the body, or a status code such as 413 or 417 to reject it.",
+)
+@click.option(
+    "--pipeline-depth",
+    type=int,
+    default=16,
+    help="Maximum number of pipelined requests to queue per connection before"
+    " parsing is paused.",
+    show_default=True,
+)
+@click.option(
+    "--stream-request-body",
+    is_flag=True,
+    default=False,
+    help="Deliver each received request body chunk as its own 'http.request'"
+    " message instead of joining the buffered chunks.",
+)
+@click.option(
+    "--receive-chunk-size",
+    type=int,
+    default=None,
+    help="Deliver the request body in 'http.request' messages of at most this"
+    " many bytes, and stop parsing it until the application asks for more.",
+)
+@click.option(
+    "--zero-copy-body",
+    is_flag=True,
+    default=False,
+    help="Keep request body fragments as memoryview slices of the read buffer"
+    " instead of copying each one.",
+)
+@click.option(
+    "--write-batch-latency",
+    type=float,
+    default=None,
+    help="Batch response writes per connection and flush them at most this many"
+    " seconds later. 0 flushes at the end of each event loop iteration."
+    " Disabled by default.",
+)
+@click.option(
+    "--read-high-water",
+    type=int,
+    default=65536,
+    help="Number of buffered request body bytes per connection above which"
+    " reading from the client is paused.",
+    show_default=True,
+)
+@click.option(
+    "--write-high-water",
+    type=int,
+    default=None,
+    help="Transport write buffer size above which the application is paused"
+    " until the buffer drains. Defaults to the event loop's limit.",
+)
+@click.option(
+    "--write-low-water",
+    type=int,
+    default=None,
+    help="Transport write buffer size below which the application resumes"
+    " writing. Defaults to the event loop's limit.",
+)
+@click.option(
+    "--read-memory-budget",
+    type=int,
+    default=None,
+    help="Number of buffered request body bytes across all connections above"
+    " which the connections holding the most data stop reading.",
+)
 @click.option(
     "--timeout-keep-alive",
     type=int,
@@ -330,6 +496,7 @@ def main(
     uds: str,
     fd: int,
     loop: str,
+    http: str,
     ws: str,
     ws_max_size: int,
     ws_ping_interval: float,
@@ -343,6 +510,10 @@ def main(
     reload_excludes: typing.List[str],
     reload_delay: float,
     workers: int,
+    reuse_port: bool,
+    reuse_port_cbpf: bool,
+    cpu_affinity: str,
+    preload: bool,
     env_file: str,
     log_config: str,
     log_level: str,
@@ -355,6 +526,23 @@ def main(
     limit_concurrency: int,
     backlog: int,
     limit_max_requests: int,
+    limit_max_requests_jitter: int,
+    limit_worker_memory: int,
+    timeout_worker_heartbeat: int,
+    limit_request_line: int,
+    limit_request_headers: int,
+    limit_request_header_size: int,
+    limit_request_body: int,
+    expect_hook: str,
+    pipeline_depth: int,
+    stream_request_body: bool,
+    receive_chunk_size: int,
+    zero_copy_body: bool,
+    write_batch_latency: float,
+    read_high_water: int,
+    write_high_water: int,
+    write_low_water: int,
+    read_memory_budget: int,
     timeout_keep_alive: int,
     ssl_keyfile: str,
     ssl_certfile: str,
@@ -374,6 +562,7 @@ def main(
         "uds": uds,
         "fd": fd,
         "loop": loop,
+        "http": http,
         "ws": ws,
         "ws_max_size": ws_max_size,
         "ws_ping_interval": ws_ping_interval,
@@ -391,6 +580,10 @@ def main(
         "reload_excludes": reload_excludes if reload_excludes else None,
         "reload_delay": reload_delay,
         "workers": workers,
+        "reuse_port": reuse_port,
+        "reuse_port_cbpf": reuse_port_cbpf,
+        "cpu_affinity": cpu_affinity,
+        "preload": preload,
         "proxy_headers": proxy_headers,
         "server_header": server_header,
         "date_header": date_header,
@@ -399,6 +592,23 @@ def main(
         "limit_concurrency": limit_concurrency,
         "backlog": backlog,
         "limit_max_requests": limit_max_requests,
+        "limit_max_requests_jitter": limit_max_requests_jitter,
+        "limit_worker_memory": limit_worker_memory,
+        "timeout_worker_heartbeat": timeout_worker_heartbeat,
+        "limit_request_line": limit_request_line,
+        "limit_request_headers": limit_request_headers,
+        "limit_request_header_size": limit_request_header_size,
+        "limit_request_body": limit_request_body,
+        "expect_hook": expect_hook,
+        "pipeline_depth": pipeline_depth,
+        "stream_request_body": stream_request_body,
+        "receive_chunk_size": receive_chunk_size,
+        "zero_copy_body": zero_copy_body,
+        "write_batch_latency": write_batch_latency,
+        "read_high_water": read_high_water,
+        "write_high_water": write_high_water,
+        "write_low_water": write_low_water,
+        "read_memory_budget": read_memory_budget,
         "timeout_keep_alive": timeout_keep_alive,
         "ssl_keyfile": ssl_keyfile,
         "ssl_certfile": ssl_certfile,
@@ -431,6 +641,10 @@ def run(app: typing.Union[ASGIApplication, str], **kwargs: typing.Any) -> None:
         )
         sys.exit(1)
 
+    if config.cpu_affinity and config.workers == 1:
+        # Inherited by the reloader's child process.
+        os.sched_setaffinity(0, worker_cpus(config.cpu_affinity, 1)[0])
+
     if config.should_reload:
         sock = config.bind_socket()
         ChangeReload(config, target=server.run, sockets=[sock]).run()
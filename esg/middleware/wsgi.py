@@ -105,13 +105,13 @@ class WSGIResponder:
         self, receive: ASGIReceiveCallable, send: ASGISendCallable
     ) -> None:
         message: HTTPRequestEvent = await receive()  # type: ignore[assignment]
-        body = message.get("body", b"")
+        chunks = [message.get("body", b"")]
         more_body = message.get("more_body", False)
         while more_body:
             body_message: HTTPRequestEvent = await receive()  # type: ignore[assignment]
-            body += body_message.get("body", b"")
+            chunks.append(body_message.get("body", b""))
             more_body = body_message.get("more_body", False)
-        environ = build_environ(self.scope, message, body)
+        environ = build_environ(self.scope, message, b"".join(chunks))
         self.loop = asyncio.get_event_loop()
         wsgi = self.loop.run_in_executor(
             self.executor, self.wsgi, environ, self.start_response
@@ -42,6 +42,10 @@ cdef extern from "llhttp.h":
         llhttp_cb      on_message_complete
         llhttp_cb      on_chunk_header
         llhttp_cb      on_chunk_complete
+        llhttp_cb      on_url_complete
+        llhttp_cb      on_status_complete
+        llhttp_cb      on_header_field_complete
+        llhttp_cb      on_header_value_complete
     ctypedef llhttp_settings_s llhttp_settings_t
 
     enum llhttp_type:
@@ -145,6 +149,10 @@ cdef extern from "llhttp.h":
 
     llhttp_errno_t llhttp_execute(llhttp_t* parser, const char* data, size_t len)
 
+    void llhttp_pause(llhttp_t* parser)
+
+    void llhttp_resume(llhttp_t* parser)
+
     void llhttp_resume_after_upgrade(llhttp_t* parser)
 
     int llhttp_should_keep_alive(const llhttp_t* parser)
@@ -4,6 +4,8 @@ __all__ = (
     "HttpParserInvalidStatusError",
     "HttpParserInvalidMethodError",
     "HttpParserInvalidURLError",
+    "HttpParserURLTooLongError",
+    "HttpParserHeadersTooLargeError",
     "HttpParserUpgrade",
 )
 
@@ -28,5 +30,13 @@ class HttpParserInvalidURLError(HttpParserError):
     pass
 
 
+class HttpParserURLTooLongError(HttpParserError):
+    pass
+
+
+class HttpParserHeadersTooLargeError(HttpParserError):
+    pass
+
+
 class HttpParserUpgrade(Exception):
     pass
@@ -1,15 +1,45 @@
 cdef tuple CLOSE_HEADER
 
-cdef int HIGH_WATER_LIMIT
+
+cdef class FlowControl
+
+
+cdef class ReadBudget:
+    cdef:
+        readonly Py_ssize_t limit
+        readonly Py_ssize_t used
+
+        dict buckets
+        set paused
+
+    cdef add(self, FlowControl flow, Py_ssize_t size)
+
+    cdef release(self, FlowControl flow, Py_ssize_t size)
+
+    cdef _track(self, FlowControl flow)
+
+    cdef _pause(self)
+
+    cdef _resume(self, FlowControl flow)
 
 
 cdef class FlowControl:
     cdef:
-        _transport, _is_writable_event
+        _transport, _drain_waiter
 
         int read_paused
         int write_paused
 
+        # request data held by the connection, counted against the budget
+        ReadBudget budget
+        Py_ssize_t buffered
+        int budget_paused
+        int size_class
+        # buffered size above which the connection pauses on its own
+        Py_ssize_t high_water
+
+    cdef drain(self)
+
     cdef inline pause_reading(self)
 
     cdef inline resume_reading(self)
@@ -17,3 +47,7 @@ cdef class FlowControl:
     cdef inline pause_writing(self)
 
     cdef inline resume_writing(self)
+
+    cdef inline add_buffered(self, Py_ssize_t size)
+
+    cdef inline release_buffered(self, Py_ssize_t size)
@@ -10,20 +10,124 @@ from asgiref.typing import (
 
 CLOSE_HEADER = (b"connection", b"close")
 
-HIGH_WATER_LIMIT = 65536
+
+cdef extern from "Python.h":
+    Py_ssize_t PY_SSIZE_T_MAX
+
+
+cdef inline int _size_class(Py_ssize_t size):
+    # Power of two just above size, 0 for no data at all.
+    cdef int size_class = 0
+
+    while size:
+        size >>= 1
+        size_class += 1
+    return size_class
+
+
+cdef class ReadBudget:
+    """
+    Memory budget for the request data buffered by all connections together.
+
+    Once it's exceeded, the connections holding the most data stop reading
+    first, until the ones still reading hold no more than half the budget.
+    They resume once usage is back under half the budget, or as soon as their
+    own data has been consumed.
+
+    Connections are kept in buckets by the power of two of the data they hold,
+    so that the largest ones are found without sorting all of them.
+    """
+
+    def __cinit__(self, Py_ssize_t limit) -> None:
+        self.limit = limit
+        self.used = 0
+        self.buckets = {}
+        self.paused = set()
+
+    cdef add(self, FlowControl flow, Py_ssize_t size):
+        self.used += size
+        self._track(flow)
+        if self.used > self.limit and not flow.budget_paused:
+            self._pause()
+
+    cdef release(self, FlowControl flow, Py_ssize_t size):
+        cdef FlowControl paused
+
+        self.used -= size
+        self._track(flow)
+        if not flow.buffered and flow.budget_paused:
+            self._resume(flow)
+
+        if self.paused and self.used <= self.limit // 2:
+            for paused in list(self.paused):
+                self._resume(paused)
+
+    cdef _track(self, FlowControl flow):
+        cdef int size_class = _size_class(flow.buffered)
+        cdef set bucket
+
+        if size_class == flow.size_class:
+            return
+        if flow.size_class:
+            bucket = self.buckets[flow.size_class]
+            bucket.discard(flow)
+            if not bucket:
+                del self.buckets[flow.size_class]
+        if size_class:
+            bucket = self.buckets.get(size_class)
+            if bucket is None:
+                bucket = self.buckets[size_class] = set()
+            bucket.add(flow)
+        flow.size_class = size_class
+
+    cdef _pause(self):
+        cdef FlowControl flow
+        cdef Py_ssize_t reading = self.used
+
+        for size_class in sorted(self.buckets, reverse=True):
+            for flow in self.buckets[size_class]:
+                if reading <= self.limit // 2:
+                    return
+                if not flow.budget_paused:
+                    flow.budget_paused = True
+                    flow.pause_reading()
+                    self.paused.add(flow)
+                reading -= flow.buffered
+
+    cdef _resume(self, FlowControl flow):
+        self.paused.discard(flow)
+        flow.budget_paused = False
+        # Still over its own high water mark, the connection resumes once
+        # the application has consumed its data.
+        if flow.buffered <= flow.high_water:
+            flow.resume_reading()
 
 
 cdef class FlowControl:
 
-    def __cinit__(self, transport: asyncio.Transport) -> None:
+    def __cinit__(
+        self, transport: asyncio.Transport, ReadBudget budget = None
+    ) -> None:
         self._transport = transport
         self.read_paused = False
         self.write_paused = False
-        self._is_writable_event = asyncio.Event()
-        self._is_writable_event.set()
+        self._drain_waiter = None
+        self.budget = budget
+        self.buffered = 0
+        self.budget_paused = False
+        self.size_class = 0
+        self.high_water = PY_SSIZE_T_MAX
+
+    cdef drain(self):
+        # Future to await while writing is paused. It's only created once
+        # the transport actually pushes back, and shared by all writers.
+        cdef object waiter = self._drain_waiter
 
-    async def drain(self) -> None:
-        await self._is_writable_event.wait()
+        if waiter is None or waiter.done():
+            waiter = self._drain_waiter = asyncio.get_event_loop().create_future()
+            if not self.write_paused:
+                waiter.set_result(None)
+        return waiter
 
     cdef inline pause_reading(self):
         if not self.read_paused:
@@ -31,16 +135,33 @@ cdef class FlowControl:
             self._transport.pause_reading()
 
     cdef inline resume_reading(self):
-        if self.read_paused:
+        if self.read_paused and not self.budget_paused:
             self.read_paused = False
             self._transport.resume_reading()
 
     cdef inline pause_writing(self):
-        if not self.write_paused:
-            self.write_paused = True
-            self._is_writable_event.clear()
+        self.write_paused = True
 
     cdef inline resume_writing(self):
+        cdef object waiter
+
         if self.write_paused:
             self.write_paused = False
-            self._is_writable_event.set()
+            waiter = self._drain_waiter
+            if waiter is not None:
+                self._drain_waiter = None
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    cdef inline add_buffered(self, Py_ssize_t size):
+        self.buffered += size
+        if self.budget is not None:
+            self.budget.add(self, size)
+
+    cdef inline release_buffered(self, Py_ssize_t size):
+        # Released data may already be accounted for after a disconnect.
+        size = min(size, self.buffered)
+        if size:
+            self.buffered -= size
+            if self.budget is not None:
+                self.budget.release(self, size)
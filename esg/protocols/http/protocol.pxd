@@ -12,15 +12,31 @@ cdef class Protocol:
 
     cdef:
         cparser.llhttp_t* _cparser
-        cparser.llhttp_settings_t* _csettings
 
+        bytes _current_url
         bytes _current_header_name
-        bytes _current_header_value
+
+        # Header name or value being parsed, see _on_header_span().
+        const char* _span_at
+        size_t _span_length
+        char* _scratch
+        size_t _scratch_size
+        size_t _scratch_length
+        size_t _header_size
+        # Set once the headers are in, chunked trailer fields are dropped.
+        int _parsing_trailers
+
+        # request limits, 0 when disabled
+        Py_ssize_t limit_request_line
+        Py_ssize_t limit_request_headers
+        size_t limit_request_header_size
 
         _proto_on_chunk_header, _proto_on_chunk_complete, _proto_on_message_begin
 
         object _last_error
 
+        object __weakref__
+
         Py_buffer py_buf
 
         # proto
@@ -30,10 +46,9 @@ cdef class Protocol:
         on_connection_lost, _loop, logger, access_logger, access_log, ws_protocol_class
         limit_concurrency, timeout_keep_alive
         server_state, connections, tasks, _transport, server, client
-        scheme, message_event, run_asgi_event, worker, chunked_encoding
+        scheme, message_event, worker, chunked_encoding
 
         FlowControl flow
-        list default_headers
 
         str root_path
 
@@ -46,26 +61,97 @@ cdef class Protocol:
         int response_complete
         int expected_content_length
 
+        # write batching
+        list _output
+        Py_ssize_t _output_size
+        int _flush_scheduled
+        object write_batch_latency
+        Py_ssize_t write_high_water
+
         int request_processing
-        bytes body
+        int request_ready
+        int message_ready
+        object body
+        Py_ssize_t body_size
         int more_body
+        Py_ssize_t body_received
+        int body_rejected
+        Py_ssize_t limit_request_body
+        object expect_hook
+        Py_ssize_t read_high_water
+        Py_ssize_t receive_chunk_size
+        int stream_request_body
+
+        # zero-copy body slices
+        int zero_copy_body
+        object _data
+        const char* _data_base
         int disconnected
         int keep_alive
-        int idle
+        double idle
+        int timer_armed
+
+        # instance reuse, bumped for every new connection
+        readonly int generation
+        int pooled
+
+        # pipelining
+        object pipeline
+        int pipeline_depth
+        int parsing_pipelined
+        int headers_pending
+        int parser_paused
+        int body_paused
+        bytes _unparsed
+
+        # buffered protocol
+        bytearray _recv_buffer
+        object _recv_view
+
+    cdef _reset(self)
+
+    cdef _maybe_release(self)
+
+    cdef _reject_body(self, bint app_started, int status_code=*)
+
+    cdef inline _drop_body(self)
+
+    cdef inline _on_header_span(self, const char* at, size_t length)
 
-    cdef inline _maybe_call_on_header(self)
+    cdef inline _save_span(self)
 
-    cdef inline _on_header_field(self, bytes field)
+    cdef _scratch_append(self, const char* at, size_t length)
 
-    cdef inline _on_header_value(self, bytes val)
+    cdef inline _on_header_field_complete(self)
+
+    cdef inline _on_header_value_complete(self)
 
     cdef inline _on_headers_complete(self)
 
     cdef inline _on_chunk_header(self)
 
-    cdef _on_url(self, url)
+    cdef inline _on_url_fragment(self, bytes url)
+
+    cdef _on_url(self, bytes url)
 
-    cdef inline _on_body(self, bytes body)
+    cdef inline _on_body(self, object body)
 
     cdef inline _on_message_complete(self)
 
+    cdef inline _maybe_resume_reading(self)
+
+    cdef _resume_parser(self)
+
+    cdef _next_request(self)
+    cdef _pop_request(self)
+
+    cdef _execute(self, const char* data, size_t data_len)
+
+    cdef _write_output(self)
+
+    cdef _start_worker(self)
+
+    cdef inline _set_message_ready(self)
+
+    cdef inline _schedule_flush(self)
+
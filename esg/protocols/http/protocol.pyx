@@ -10,26 +10,34 @@ from cpython cimport (
     PyBytes_AsString,
     PyObject_GetBuffer,
 )
-from cpython.mem cimport PyMem_Free, PyMem_Malloc
+from cpython.bytearray cimport PyByteArray_AS_STRING
+from cpython.mem cimport PyMem_Free, PyMem_Malloc, PyMem_Realloc
+from cpython.unicode cimport PyUnicode_DecodeUTF8
+from libc.string cimport memcpy
 
 from esg.protocols.http cimport cparser, url_cparser as uparser
-from esg.protocols.http.flow_control cimport CLOSE_HEADER, HIGH_WATER_LIMIT, FlowControl
+from esg.protocols.http.flow_control cimport CLOSE_HEADER, FlowControl
 from esg.protocols.http.python cimport PyMemoryView_Check, PyMemoryView_GET_BUFFER
 
 import asyncio
 import http
 import logging
+import os
 import re
-from urllib.parse import unquote
+from collections import OrderedDict, deque
+from time import time
+from weakref import ref
 
 from esg.logging import TRACE_LOG_LEVEL
 from esg.protocols.http.errors import (
     HttpParserCallbackError,
     HttpParserError,
+    HttpParserHeadersTooLargeError,
     HttpParserInvalidMethodError,
     HttpParserInvalidStatusError,
     HttpParserInvalidURLError,
     HttpParserUpgrade,
+    HttpParserURLTooLongError,
 )
 from esg.protocols.http.flow_control import FlowControl
 from esg.protocols.utils import (
@@ -65,40 +73,300 @@ SERVICE_UNAVAILABLE = (
     b"Service Unavailable"
 )
 
+CONTINUE_RESPONSE = b"HTTP/1.1 100 Continue\r\n\r\n"
 
-cdef class Protocol:
+URI_TOO_LONG = (
+    b"HTTP/1.1 414 URI Too Long\r\n"
+    b"content-type: text/plain; charset=utf-8\r\n"
+    b"connection: close\r\n"
+    b"content-length: 12\r\n\r\n"
+    b"URI Too Long"
+)
 
-    def __cinit__(self, config, server_state, on_connection_lost = None, _loop=None):
-        self._cparser = <cparser.llhttp_t*> \
-                                PyMem_Malloc(sizeof(cparser.llhttp_t))
-        if self._cparser is NULL:
-            raise MemoryError()
+REQUEST_HEADER_FIELDS_TOO_LARGE = (
+    b"HTTP/1.1 431 Request Header Fields Too Large\r\n"
+    b"content-type: text/plain; charset=utf-8\r\n"
+    b"connection: close\r\n"
+    b"content-length: 31\r\n\r\n"
+    b"Request Header Fields Too Large"
+)
 
-        self._csettings = <cparser.llhttp_settings_t*> \
-                                PyMem_Malloc(sizeof(cparser.llhttp_settings_t))
-        if self._csettings is NULL:
-            raise MemoryError()
+# Size of the per-connection receive buffer used by BufferedProtocol.
+RECV_BUFFER_SIZE = 16 * 1024
 
-        cparser.llhttp_settings_init(self._csettings)
+# Size of the reads used to send a file when the transport can't sendfile.
+SENDFILE_CHUNK_SIZE = 64 * 1024
 
-        cparser.llhttp_init(self._cparser, cparser.HTTP_REQUEST, self._csettings)
-        self._cparser.data = <void*>self
+# Header scratch buffers grown past this size are released between requests.
+HEADER_SCRATCH_SIZE = 8 * 1024
 
-        self._current_header_name = None
-        self._current_header_value = None
+# Maximum number of parsed request URLs kept around, and the longest URL
+# that gets cached.
+URL_CACHE_SIZE = 4096
+URL_CACHE_MAX_LENGTH = 1024
 
-        self.expect_100_continue = False
-        self.headers = []
-        self._scope = {}
-        self.url = b""
+# Parsed request URLs, keyed on the raw URL bytes.
+cdef object _url_cache = OrderedDict()
+
+
+cdef inline int _hex_value(char c):
+    if c'0' <= c <= c'9':
+        return c - c'0'
+    if c'a' <= c <= c'f':
+        return c - c'a' + 10
+    if c'A' <= c <= c'F':
+        return c - c'A' + 10
+    return -1
+
+
+cdef str _percent_decode(const char* data, Py_ssize_t length):
+    # Same result as urllib.parse.unquote() for ASCII input: percent-encoded
+    # octets are decoded as UTF-8, invalid escapes are left untouched.
+    cdef char* decoded = <char*>PyMem_Malloc(length)
+    cdef Py_ssize_t i = 0
+    cdef Py_ssize_t n = 0
+    cdef int high, low
+
+    if decoded is NULL:
+        raise MemoryError()
+    try:
+        while i < length:
+            if data[i] == c'%' and i + 2 < length:
+                high = _hex_value(data[i + 1])
+                low = _hex_value(data[i + 2])
+                if high >= 0 and low >= 0:
+                    decoded[n] = <char>(high * 16 + low)
+                    n += 1
+                    i += 3
+                    continue
+            decoded[n] = data[i]
+            n += 1
+            i += 1
+        return PyUnicode_DecodeUTF8(decoded, n, "replace")
+    finally:
+        PyMem_Free(decoded)
+
+
+cdef tuple _parse_url(bytes url):
+    cdef:
+        uparser.http_parser_url parsed
+        const char* buf_data = url
+        bytes raw_path = None
+        bytes query = b""
+        str path
+        int off
+        int ln
+
+    uparser.http_parser_url_init(&parsed)
+    if uparser.http_parser_parse_url(buf_data, len(url), 0, &parsed) != 0:
+        raise HttpParserInvalidURLError("invalid url {!r}".format(url))
+
+    if parsed.field_set & (1 << uparser.UF_PATH):
+        off = parsed.field_data[<int>uparser.UF_PATH].off
+        ln = parsed.field_data[<int>uparser.UF_PATH].len
+        raw_path = buf_data[off:off+ln]
+
+    if parsed.field_set & (1 << uparser.UF_QUERY):
+        off = parsed.field_data[<int>uparser.UF_QUERY].off
+        ln = parsed.field_data[<int>uparser.UF_QUERY].len
+        query = buf_data[off:off+ln]
+
+    path = raw_path.decode("ascii")
+    if "%" in path:
+        path = _percent_decode(raw_path, len(raw_path))
+    return path, raw_path, query
+
+
+cdef tuple get_url(bytes url):
+    cdef tuple parsed = _url_cache.get(url)
+
+    if parsed is not None:
+        _url_cache.move_to_end(url)
+        return parsed
+
+    parsed = _parse_url(url)
+    if len(url) <= URL_CACHE_MAX_LENGTH:
+        _url_cache[url] = parsed
+        if len(_url_cache) > URL_CACHE_SIZE:
+            _url_cache.popitem(last=False)
+    return parsed
+
+
+# Request header names that are matched straight from the parser buffer and
+# returned as shared, already lowercased objects instead of fresh copies.
+COMMON_HEADER_NAMES = (
+    b"accept",
+    b"accept-charset",
+    b"accept-encoding",
+    b"accept-language",
+    b"access-control-request-headers",
+    b"access-control-request-method",
+    b"authorization",
+    b"cache-control",
+    b"connection",
+    b"content-encoding",
+    b"content-length",
+    b"content-type",
+    b"cookie",
+    b"date",
+    b"dnt",
+    b"expect",
+    b"forwarded",
+    b"from",
+    b"host",
+    b"if-match",
+    b"if-modified-since",
+    b"if-none-match",
+    b"if-range",
+    b"if-unmodified-since",
+    b"keep-alive",
+    b"origin",
+    b"pragma",
+    b"range",
+    b"referer",
+    b"sec-fetch-dest",
+    b"sec-fetch-mode",
+    b"sec-fetch-site",
+    b"sec-fetch-user",
+    b"sec-websocket-extensions",
+    b"sec-websocket-key",
+    b"sec-websocket-protocol",
+    b"sec-websocket-version",
+    b"te",
+    b"trailer",
+    b"transfer-encoding",
+    b"upgrade",
+    b"upgrade-insecure-requests",
+    b"user-agent",
+    b"via",
+    b"x-forwarded-for",
+    b"x-forwarded-host",
+    b"x-forwarded-port",
+    b"x-forwarded-proto",
+    b"x-real-ip",
+    b"x-request-id",
+    b"x-requested-with",
+)
+
+# COMMON_HEADER_NAMES grouped by length.
+cdef list _common_header_names = [
+    [name for name in COMMON_HEADER_NAMES if len(name) == length]
+    for length in range(max([len(name) for name in COMMON_HEADER_NAMES]) + 1)
+]
+
+
+cdef bytes get_header_name(const char* data, size_t length):
+    cdef:
+        bytes name
+        const char* candidate
+        size_t i
+        char c
+
+    if length < <size_t>len(_common_header_names):
+        for name in <list>_common_header_names[length]:
+            candidate = name
+            for i in range(length):
+                c = data[i]
+                if c'A' <= c <= c'Z':
+                    c += 32
+                if c != candidate[i]:
+                    break
+            else:
+                return name
+
+    return data[:length].lower()
+
+
+# Maximum number of serialized response header blocks kept around.
+HEADER_CACHE_SIZE = 256
+
+# Serialized header blocks, keyed on the status code, the response headers
+# and the request details that change how they are rendered. The cache is
+# dropped whenever the server replaces its default headers.
+cdef object _header_cache = OrderedDict()
+cdef list _header_cache_defaults = None
+
+
+cdef tuple _build_header_block(int status_code, list headers, bint is_head):
+    cdef bytes name
+    cdef bytes value
+    cdef list content = [STATUS_LINE[status_code]]
+    cdef int expected_content_length = 0
+    cdef object chunked_encoding = None
+    cdef bint keep_alive = True
+
+    for name, value in headers:
+        # Should be active only in development mode.
+        # if HEADER_RE.search(name):
+        #     raise RuntimeError("Invalid HTTP header name.")
+        # if HEADER_VALUE_RE.search(value):
+        #     raise RuntimeError("Invalid HTTP header value.")
+
+        name = name.lower()
+        if name == b"content-length" and chunked_encoding is None:
+            expected_content_length = int(value)
+            chunked_encoding = False
+        elif name == b"transfer-encoding" and value.lower() == b"chunked":
+            expected_content_length = 0
+            chunked_encoding = True
+        elif name == b"connection" and value.lower() == b"close":
+            keep_alive = False
+        content.extend((name, b": ", value, b"\r\n"))
+
+    if chunked_encoding is None and not is_head and status_code not in (204, 304):
+        # Neither content-length nor transfer-encoding specified
+        chunked_encoding = True
+        content.append(b"transfer-encoding: chunked\r\n\r\n")
+    else:
+        content.append(b"\r\n")
+
+    return b"".join(content), expected_content_length, chunked_encoding, keep_alive
+
+
+cdef tuple get_header_block(
+    int status_code, list default_headers, object headers, bint close, bint is_head
+):
+    global _header_cache_defaults
+    cdef tuple key
+    cdef tuple block
+
+    if default_headers is not _header_cache_defaults:
+        _header_cache.clear()
+        _header_cache_defaults = default_headers
+
+    # Iterated only once, the application may pass a generator.
+    headers = tuple(headers)
+    try:
+        key = (status_code, headers, close, is_head)
+        block = _header_cache.get(key)
+    except TypeError:
+        # Header pairs given as lists can not be used as a key.
+        key = None
+        block = None
+
+    if block is not None:
+        _header_cache.move_to_end(key)
+        return block
+
+    response_headers = default_headers + list(headers)
+    if close and CLOSE_HEADER not in response_headers:
+        response_headers.append(CLOSE_HEADER)
+    block = _build_header_block(status_code, response_headers, is_head)
 
-        # Callbacks
-        self._csettings.on_header_field = cb_on_header_field
-        self._csettings.on_header_value = cb_on_header_value
-        self._csettings.on_url = cb_on_url
-        self._csettings.on_headers_complete = cb_on_headers_complete
-        self._csettings.on_message_complete = cb_on_message_complete
-        self._csettings.on_body = cb_on_body
+    if key is not None:
+        _header_cache[key] = block
+        if len(_header_cache) > HEADER_CACHE_SIZE:
+            _header_cache.popitem(last=False)
+    return block
+
+
+cdef class Protocol:
+
+    def __cinit__(self, config, server_state, on_connection_lost = None, _loop=None):
+        self._cparser = <cparser.llhttp_t*> \
+                                PyMem_Malloc(sizeof(cparser.llhttp_t))
+        if self._cparser is NULL:
+            raise MemoryError()
 
         if not config.loaded:
             config.load()
@@ -113,16 +381,58 @@ cdef class Protocol:
         self.ws_protocol_class = config.ws_protocol_class
         self.root_path = config.root_path
         self.limit_concurrency = config.limit_concurrency
+        self.stream_request_body = config.stream_request_body
+        self.zero_copy_body = config.zero_copy_body
+        self.write_batch_latency = config.write_batch_latency
+        # The transport's high-water mark, as set by asyncio.
+        if config.write_high_water is not None:
+            self.write_high_water = config.write_high_water
+        elif config.write_low_water is not None:
+            self.write_high_water = 4 * config.write_low_water
+        else:
+            self.write_high_water = 64 * 1024
+        self.pipeline_depth = config.pipeline_depth
+        self.limit_request_line = config.limit_request_line
+        self.limit_request_headers = config.limit_request_headers
+        self.limit_request_header_size = config.limit_request_header_size
+        self.limit_request_body = config.limit_request_body or 0
+        self.expect_hook = config.loaded_expect_hook
+        self.read_high_water = config.read_high_water
+        self.receive_chunk_size = config.receive_chunk_size or 0
 
         # Timeouts
         self.timeout_keep_alive = config.timeout_keep_alive
-        self.keep_alive = bool(self.timeout_keep_alive)
 
         # Global state
         self.server_state = server_state
         self.connections = server_state.connections
         self.tasks = server_state.tasks
-        self.default_headers = server_state.default_headers
+
+        self.pipeline = deque()
+        self.generation = 0
+        self._reset()
+
+    cdef _reset(self):
+        cparser.llhttp_init(self._cparser, cparser.HTTP_REQUEST, &_csettings)
+        self._cparser.data = <void*>self
+
+        self._current_url = None
+        self._current_header_name = None
+        self._span_at = NULL
+        self._scratch_length = 0
+        self._header_size = 0
+        self._parsing_trailers = False
+        if self._scratch_size > HEADER_SCRATCH_SIZE:
+            PyMem_Free(self._scratch)
+            self._scratch = NULL
+            self._scratch_size = 0
+
+        self.expect_100_continue = False
+        self.headers = []
+        self._scope = {}
+        self.url = b""
+
+        self.keep_alive = bool(self.timeout_keep_alive)
 
         # Per-connection state
         self._transport = None
@@ -130,17 +440,23 @@ cdef class Protocol:
         self.server = None
         self.client = None
         self.scheme = None
+        self._connection_scope = None
 
         ## From cycle
-        self.message_event = self._loop.create_future()
-        self.run_asgi_event = self._loop.create_future()
-        self.worker = self._loop.create_task(self.run_asgi())
-        self.tasks.add(self.worker)
-        self.worker.add_done_callback(self.tasks.discard)
+        # The ASGI task and the futures are only created once needed
+        self.message_event = None
+        self.message_ready = False
+        self.request_ready = False
+        self.worker = None
 
         self.disconnected = False
-        self.body = b""
+        self.body = deque()
+        self.body_size = 0
         self.more_body = True
+        self.body_received = 0
+        self.body_rejected = False
+        self._data = None
+        self._data_base = NULL
 
         # Response state
         self.response_started = False
@@ -148,11 +464,35 @@ cdef class Protocol:
         self.chunked_encoding = None
         self.expected_content_length = 0
 
+        # Write batching
+        self._output = []
+        self._output_size = 0
+        self._flush_scheduled = False
+
         self.idle = 0
+        self.timer_armed = False
+        self.pooled = False
         self.request_processing = False
 
+        # Pipelining
+        self.pipeline.clear()
+        self.parsing_pipelined = False
+        self.headers_pending = False
+        self.parser_paused = False
+        self.body_paused = False
+        self._unparsed = b""
+
         self._last_error = None
 
+    def reset(self):
+        """
+        Prepares a closed protocol instance to be used for a new connection.
+        """
+        # Timers and flushes still scheduled for the previous connection
+        # see the change and do nothing.
+        self.generation += 1
+        self._reset()
+
     @property
     def loop(self):
         return self._loop
@@ -167,135 +507,213 @@ cdef class Protocol:
 
     def __dealloc__(self):
         PyMem_Free(self._cparser)
-        PyMem_Free(self._csettings)
+        PyMem_Free(self._scratch)
+
+    cdef inline _on_header_span(self, const char* at, size_t length):
+        self._header_size += length
+        if 0 < self.limit_request_header_size < self._header_size:
+            raise HttpParserHeadersTooLargeError("request header too large")
+
+        # A header name or value is referenced in place while it lies within
+        # the data being parsed, it's only copied to the scratch buffer when
+        # it continues in a later read.
+        if self._span_at is NULL and self._scratch_length == 0:
+            self._span_at = at
+            self._span_length = length
+        else:
+            self._save_span()
+            self._scratch_append(at, length)
 
-    cdef inline _maybe_call_on_header(self):
-        cdef bytes header_name
+    cdef inline _save_span(self):
+        if self._span_at is not NULL:
+            self._scratch_append(self._span_at, self._span_length)
+            self._span_at = NULL
 
-        if self._current_header_value is not None:
-            header_name = self._current_header_name.lower()
-            if header_name == b"expect" and self._current_header_value.lower() == b"100-continue":
-                self.expect_100_continue = True
+    cdef _scratch_append(self, const char* at, size_t length):
+        cdef:
+            size_t size = self._scratch_length + length
+            char* scratch
+
+        if size > self._scratch_size:
+            size = max(size, 2 * self._scratch_size, 256)
+            scratch = <char*>PyMem_Realloc(self._scratch, size)
+            if scratch is NULL:
+                raise MemoryError()
+            self._scratch = scratch
+            self._scratch_size = size
+
+        memcpy(self._scratch + self._scratch_length, at, length)
+        self._scratch_length += length
+
+    cdef inline _on_header_field_complete(self):
+        if self._parsing_trailers:
+            self._span_at = NULL
+            self._scratch_length = 0
+            return
 
-            self.headers.append((header_name, self._current_header_value))
-            self._current_header_name = self._current_header_value = None
+        if 0 < self.limit_request_headers <= len(self.headers):
+            raise HttpParserHeadersTooLargeError("too many request headers")
 
-    cdef inline _on_header_field(self, bytes field):
-        self._maybe_call_on_header()
-        if self._current_header_name is None:
-            self._current_header_name = field
+        if self._span_at is not NULL:
+            self._current_header_name = get_header_name(self._span_at, self._span_length)
+            self._span_at = NULL
         else:
-            self._current_header_name += field
+            self._current_header_name = get_header_name(self._scratch, self._scratch_length)
+            self._scratch_length = 0
 
-    cdef inline _on_header_value(self, bytes val):
-        if self._current_header_value is None:
-            self._current_header_value = val
+    cdef inline _on_header_value_complete(self):
+        cdef:
+            bytes name = self._current_header_name
+            bytes value
+
+        if self._parsing_trailers:
+            # The application already has the scope.
+            self._span_at = NULL
+            self._scratch_length = 0
+            self._header_size = 0
+            return
+
+        if self._span_at is not NULL:
+            value = self._span_at[:self._span_length]
+            self._span_at = NULL
+        elif self._scratch_length:
+            value = self._scratch[:self._scratch_length]
+            self._scratch_length = 0
         else:
-            self._current_header_value += val
+            value = b""
 
-    cdef inline _on_headers_complete(self):
-        self._maybe_call_on_header()
+        if name == b"expect" and value.lower() == b"100-continue":
+            if self.parsing_pipelined:
+                self.pipeline[-1][3] = True
+            else:
+                self.expect_100_continue = True
 
-        if self.limit_concurrency is not None and len(self.connections) >= self.limit_concurrency:
-            if not self._transport.is_closing():
-                self._transport.write(SERVICE_UNAVAILABLE)
-                self._transport.close()
-                return
+        self.headers.append((name, value))
+        self._current_header_name = None
+        self._header_size = 0
+
+    cdef inline _on_headers_complete(self):
+        cdef dict scope
+
+        self.headers_pending = False
+        self._parsing_trailers = True
+        if self.parsing_pipelined:
+            if self._cparser.upgrade == 1:
+                raise HttpParserError("upgrade request pipelined behind a pending request")
+            scope = self.pipeline[-1][0]
+            if 0 < self.limit_request_body < <Py_ssize_t>self._cparser.content_length:
+                # Answered with a 413 once it's the request's turn.
+                self.pipeline[-1][1] = None
+        else:
+            if self.limit_concurrency is not None and len(self.connections) >= self.limit_concurrency:
+                if not self._transport.is_closing():
+                    self._write_output()
+                    self._transport.write(SERVICE_UNAVAILABLE)
+                    self._transport.close()
+                    return
+            scope = self._scope
 
         if self._cparser.http_major != 1 or self._cparser.http_minor != 1:
-            self._scope["http_version"] = '{}.{}'.format(
+            scope["http_version"] = '{}.{}'.format(
                 self._cparser.http_major,
                 self._cparser.http_minor
             )
 
-        if self._cparser.upgrade == 1:
+        if self._cparser.upgrade == 1 or self.parsing_pipelined:
             return
 
         self.response_started = self.response_complete = False
 
-        if not self.run_asgi_event.done():
-            self.run_asgi_event.set_result(True)
+        if 0 < self.limit_request_body < <Py_ssize_t>self._cparser.content_length:
+            self._reject_body(False)
+            return
+
+        if self.expect_100_continue and self.expect_hook is not None:
+            # Accept or reject the body before the application is started.
+            try:
+                status_code = self.expect_hook(scope)
+            except Exception:
+                self.logger.exception("Exception in expect hook")
+                status_code = 500
+            if status_code is not None:
+                self._reject_body(False, status_code)
+                return
+            self._write_output()
+            self._transport.write(CONTINUE_RESPONSE)
+            self.expect_100_continue = False
+
+        self.request_ready = True
+        if self.worker is None:
+            self._start_worker()
 
     cdef inline _on_chunk_header(self):
-        if (self._current_header_value is not None or
-            self._current_header_name is not None):
+        if self._current_header_name is not None or self._scratch_length:
             raise HttpParserError('invalid headers state')
 
         if self._proto_on_chunk_header is not None:
             self._proto_on_chunk_header()
 
     # cdef _on_chunk_complete(self):
-    #     self._maybe_call_on_header()
-    #
     #     if self._proto_on_chunk_complete is not None:
     #         self._proto_on_chunk_complete()
 
-    cdef _on_url(self, url):
-        self.request_processing = True
+    cdef inline _on_url_fragment(self, bytes url):
+        if self._current_url is None:
+            self._current_url = url
+        else:
+            self._current_url += url
+
+        if 0 < self.limit_request_line < len(self._current_url):
+            raise HttpParserURLTooLongError("request line too long")
+
+    cdef _on_url(self, bytes url):
         cdef:
-            Py_buffer py_buf
-            char* buf_data
-            uparser.http_parser_url* parsed
-            int res
-            bytes raw_path = None
-            bytes query = None
-            bytes method = None
-            str path = None
-            int off
-            int ln
-            cparser.llhttp_t * parser = self._cparser
-
-        parsed = <uparser.http_parser_url*> \
-                            PyMem_Malloc(sizeof(uparser.http_parser_url))
-        uparser.http_parser_url_init(parsed)
-        PyObject_GetBuffer(url, &py_buf, PyBUF_SIMPLE)
+            tuple parsed = get_url(url)
+            bytes method
+            dict scope
 
-        try:
-            buf_data = <char*>py_buf.buf
-            res = uparser.http_parser_parse_url(buf_data, py_buf.len, 0, parsed)
-
-            if res == 0:
-                if parsed.field_set & (1 << uparser.UF_PATH):
-                    off = parsed.field_data[<int>uparser.UF_PATH].off
-                    ln = parsed.field_data[<int>uparser.UF_PATH].len
-                    raw_path = buf_data[off:off+ln]
-
-                if parsed.field_set & (1 << uparser.UF_QUERY):
-                    off = parsed.field_data[<int>uparser.UF_QUERY].off
-                    ln = parsed.field_data[<int>uparser.UF_QUERY].len
-                    query = buf_data[off:off+ln]
-
-                method = cparser.llhttp_method_name( < cparser.llhttp_method_t > parser.method)
-                path = raw_path.decode("ascii")
-                if "%" in path:
-                    path = unquote(path)
-                self.url = url
-                self.expect_100_continue = False
-                self.headers = []
-                self._scope = {
-                    # Per-request state
-                    "method": method.decode(),
-                    "path": path,
-                    "raw_path": raw_path,
-                    "query_string": query or b"",
-                    "headers": self.headers,
-                    # Extract per-connection state
-                    **self._connection_scope,
-                }
-
-                self.body = b""
-                self.more_body = True
-
-                # Response state
-                self.response_started = False
-                self.response_complete = False
-                self.chunked_encoding = None
-                self.expected_content_length = 0
-            else:
-                raise HttpParserInvalidURLError("invalid url {!r}".format(url))
-        finally:
-            PyBuffer_Release(&py_buf)
-            PyMem_Free(parsed)
+        method = cparser.llhttp_method_name(<cparser.llhttp_method_t> self._cparser.method)
+        self.url = url
+        self.headers = []
+        self._parsing_trailers = False
+        scope = {
+            # Per-request state
+            "method": method.decode(),
+            "path": parsed[0],
+            "raw_path": parsed[1],
+            "query_string": parsed[2],
+            "headers": self.headers,
+            # Applications and middleware may add their own extensions.
+            "extensions": {"http.response.zerocopysend": {}},
+            # Extract per-connection state
+            **self._connection_scope,
+        }
+
+        if self.request_processing or self.pipeline or self.worker is not None:
+            # Pipelined request, it waits in the queue until the
+            # responses to all of the previous requests have been sent,
+            # and the application has returned from the last one.
+            # [scope, body, more_body, expect_100_continue, body_size]
+            self.pipeline.append([scope, deque(), True, False, 0])
+            self.parsing_pipelined = True
+            self.headers_pending = True
+            return
+
+        self.request_processing = True
+        self.expect_100_continue = False
+        self._scope = scope
+
+        self._drop_body()
+        self.more_body = True
+        self.body_received = 0
+        self.body_rejected = False
+        self.message_ready = False
+
+        # Response state
+        self.response_started = False
+        self.response_complete = False
+        self.chunked_encoding = None
+        self.expected_content_length = 0
 
 
     ### Public API ###
@@ -305,7 +723,15 @@ cdef class Protocol:
         self.connections.add(self)
 
         self._transport = transport
-        self.flow = FlowControl(transport)
+        self.flow = FlowControl(transport, self.server_state.read_budget)
+        self.flow.high_water = self.read_high_water
+        if (
+            self.config.write_high_water is not None
+            or self.config.write_low_water is not None
+        ):
+            transport.set_write_buffer_limits(
+                high=self.config.write_high_water, low=self.config.write_low_water
+            )
         self.server = get_local_addr(transport)
         self.client = get_remote_addr(transport)
         self.scheme = "https" if is_ssl(transport) else "http"
@@ -328,20 +754,17 @@ cdef class Protocol:
     def connection_lost(self, exc):
         self.connections.discard(self)
 
-        if not self.run_asgi_event.done():
-            self.run_asgi_event.set_result(False)
-
         if self.logger.level <= TRACE_LOG_LEVEL:
             prefix = "%s:%d - " % tuple(self.client) if self.client else ""
             self.logger.log(TRACE_LOG_LEVEL, "%sHTTP connection lost", prefix)
 
         self.disconnected = True
-
-        if not self.message_event.done():
-            self.message_event.set_result(True)
+        self._set_message_ready()
 
         if self.flow is not None:
             self.flow.resume_writing()
+            # Nothing is going to read the buffered request data anymore.
+            self.flow.release_buffered(self.flow.buffered)
         if exc is None:
             if not self._transport.is_closing():
                 self._transport.close()
@@ -349,13 +772,28 @@ cdef class Protocol:
         if self.on_connection_lost is not None:
             self.on_connection_lost()
 
+        self._maybe_release()
+
+    cdef _maybe_release(self):
+        # The instance goes back to the pool once nothing is left to run for
+        # the connection: the application has returned, and no flush or
+        # timer is pending.
+        if (
+            self.pooled
+            or not self.disconnected
+            or self.worker is not None
+            or self._flush_scheduled
+            or self.timer_armed
+        ):
+            return
+        if self.server_state.protocol_pool is not None:
+            self.pooled = True
+            self.server_state.protocol_pool.release(self)
+
     def eof_received(self):
         pass
 
     def handle_upgrade(self):
-        if not self.run_asgi_event.done():
-            self.run_asgi_event.set_result(False)
-
         upgrade_value = None
         for name, value in self.headers:
             if name == b"upgrade":
@@ -372,7 +810,7 @@ cdef class Protocol:
                 self.logger.warning(msg)
 
             content = [STATUS_LINE[400]]
-            for name, value in self.default_headers:
+            for name, value in self.server_state.default_headers:
                 content.extend([name, b": ", value, b"\r\n"])
             content.extend(
                 [
@@ -383,6 +821,7 @@ cdef class Protocol:
                     msg.encode("ascii"),
                 ]
             )
+            self._write_output()
             self._transport.write(b"".join(content))
             if not self._transport.is_closing():
                 self._transport.close()
@@ -393,6 +832,7 @@ cdef class Protocol:
             self.logger.log(TRACE_LOG_LEVEL, "%sUpgrading to WebSocket", prefix)
 
         self.connections.discard(self)
+        self._write_output()
 
         method = self._scope["method"].encode()
         output = [method, b" ", self.url, b" HTTP/1.1\r\n"]
@@ -408,35 +848,135 @@ cdef class Protocol:
         protocol.data_received(b"".join(output))
         self._transport.set_protocol(protocol)
 
-    cdef inline _on_body(self, bytes body):
-        if self._cparser.upgrade == 1 or self.response_complete:
+    cdef inline _on_body(self, object body):
+        cdef list request
+
+        if self._cparser.upgrade == 1:
+            return
+        if self.parsing_pipelined:
+            request = self.pipeline[-1]
+            if request[1] is None:
+                return
+            if 0 < self.limit_request_body < request[4] + len(body):
+                self.flow.release_buffered(request[4])
+                request[1] = None
+                return
+            request[1].append(body)
+            request[4] += len(body)
+            self.flow.add_buffered(len(body))
+            if request[4] > self.read_high_water:
+                self.flow.pause_reading()
             return
-        self.body += body
-        if len(self.body) > HIGH_WATER_LIMIT:
+        if self.response_complete:
+            # Nobody is reading the body anymore, drop it.
+            return
+        self.body_received += len(body)
+        if 0 < self.limit_request_body < self.body_received:
+            self._reject_body(not self.request_ready)
+            return
+        self.body.append(body)
+        self.body_size += len(body)
+        self.flow.add_buffered(len(body))
+        if 0 < self.receive_chunk_size <= self.body_size:
+            # A whole chunk is waiting, the rest of the body is left unparsed
+            # until the application asks for more.
+            self.parser_paused = self.body_paused = True
+        elif self.body_size > self.read_high_water:
             self.flow.pause_reading()
-        if not self.message_event.done():
-            self.message_event.set_result(True)
+        self._set_message_ready()
 
     cdef inline _on_message_complete(self):
-        if self._cparser.upgrade == 1 or self.response_complete:
+        if self._cparser.upgrade == 1:
             return
-        self.more_body = False
-        if not self.message_event.done():
-            self.message_event.set_result(True)
+        if self.parsing_pipelined:
+            self.pipeline[-1][2] = False
+            self.parsing_pipelined = False
+        elif not self.response_complete:
+            self.more_body = False
+            self._set_message_ready()
+
+        if (
+            (self.request_processing or self.pipeline)
+            and len(self.pipeline) >= self.pipeline_depth
+        ):
+            # The pipeline is full, stop parsing until the pending
+            # requests have been served.
+            self.parser_paused = True
+
+    cdef inline _maybe_resume_reading(self):
+        if self.flow.read_paused and not (self.parser_paused or self.parsing_pipelined):
+            self.flow.resume_reading()
+
+    cdef _resume_parser(self):
+        cdef bytes data = self._unparsed
+
+        self._unparsed = b""
+        self.parser_paused = self.body_paused = False
+        cparser.llhttp_resume(self._cparser)
+        # Parsed even when nothing is left, the message may end right where
+        # the parser was paused.
+        self.data_received(data)
+
+    cdef _next_request(self):
+        self._pop_request()
+        if self.parser_paused:
+            self._resume_parser()
+            if not self.request_ready:
+                # Parsed just now, while the last application was returning.
+                self._pop_request()
+        if self.flow is not None:
+            self._maybe_resume_reading()
+
+    cdef _pop_request(self):
+        cdef list request
+        cdef bint waiting
+
+        while self.pipeline:
+            request = self.pipeline.popleft()
+            waiting = False
+            if self.parsing_pipelined and not self.pipeline:
+                # The request being parsed right now becomes the active one.
+                self.parsing_pipelined = False
+                waiting = self.headers_pending
+
+            self.request_processing = True
+            self._scope = request[0]
+            self.more_body = request[2]
+            self.expect_100_continue = request[3]
+            self.body_received = request[4]
+            self.body_rejected = False
+            self._drop_body()
+
+            # Response state
+            self.response_started = False
+            self.response_complete = False
+            self.chunked_encoding = None
+            self.expected_content_length = 0
+
+            if request[1] is None:
+                self._reject_body(False)
+                if not self.keep_alive:
+                    break
+                continue
+
+            self.body = request[1]
+            self.body_size = request[4]
+            self.message_ready = bool(self.body) or not self.more_body
+            # Started by _on_headers_complete() once its headers are in.
+            self.request_ready = not waiting
+            break
 
     def shutdown(self):
         """
         Called by the server to commence a graceful shutdown.
         """
-        if not self.request_processing:
+        if not self.request_processing and not self.pipeline:
             if not self._transport.is_closing():
+                self._write_output()
                 self._transport.close()
         else:
             self.keep_alive = False
 
-        if not self.run_asgi_event.done():
-            self.run_asgi_event.set_result(False)
-
     def pause_writing(self):
         """
         Called by the transport when the write buffer exceeds the high water mark.
@@ -449,6 +989,27 @@ cdef class Protocol:
         """
         self.flow.resume_writing()
 
+    def on_timer(self, now, generation):
+        """
+        Called by the server once the deadline registered in the timer wheel
+        is due.
+        """
+        if generation != self.generation:
+            # Registered for a previous connection of this instance.
+            return
+        self.timer_armed = False
+        if self.disconnected:
+            self._maybe_release()
+        elif self.is_expired(now):
+            self.shutdown()
+        elif self.idle > 0 and not self.request_processing:
+            # Served another request since, wait for its deadline.
+            self.timer_armed = True
+            self.server_state.timers.schedule(
+                (ref(self), self.generation),
+                self.idle + self.timeout_keep_alive,
+            )
+
     def is_expired(self, now):
         if self.request_processing:
             return False
@@ -458,52 +1019,108 @@ cdef class Protocol:
         self.idle = 0
 
         cdef:
-            size_t data_len
-            cparser.llhttp_errno_t err
             Py_buffer *buf
             bint owning_buf = False
-            char* err_pos
+
+        if self.parser_paused:
+            # Keep the data aside until the pipelined requests are served.
+            self._unparsed += data
+            self.flow.pause_reading()
+            return
 
         if PyMemoryView_Check(data):
             buf = PyMemoryView_GET_BUFFER(data)
-            data_len = <size_t>buf.len
-            err = cparser.llhttp_execute(
-                self._cparser,
-                <char*>buf.buf,
-                data_len)
-
         else:
             buf = &self.py_buf
             PyObject_GetBuffer(data, buf, PyBUF_SIMPLE)
             owning_buf = True
-            data_len = <size_t>buf.len
-
-            err = cparser.llhttp_execute(
-                self._cparser,
-                <char*>buf.buf,
-                data_len)
 
         try:
-            if self._cparser.upgrade == 1 and err == cparser.HPE_PAUSED_UPGRADE:
-                err_pos = cparser.llhttp_get_error_pos(self._cparser)
-
-                # Immediately free the parser from "error" state, simulating
-                # http-parser behavior here because 1) we never had the API to
-                # allow users manually "resume after upgrade", and 2) the use
-                # case for resuming parsing is very rare.
-                cparser.llhttp_resume_after_upgrade(self._cparser)
-
-                # The err_pos here is specific for the input buf. So if we ever
-                # switch to the llhttp behavior (re-raise HttpParserUpgrade for
-                # successive calls to feed_data() until resume_after_upgrade is
-                # called), we have to store the result and keep our own state.
-                #raise HttpParserUpgrade(err_pos - <char*>buf.buf)
-                self.handle_upgrade()
-                return
+            if self.zero_copy_body and buf.readonly:
+                # Body slices may outlive this call only when the underlying
+                # buffer can not be reused, mutable buffers are still copied.
+                self._data = data if PyMemoryView_Check(data) else memoryview(data)
+                self._data_base = <const char*>buf.buf
+
+            self._execute(<const char*>buf.buf, <size_t>buf.len)
         finally:
+            self._data = None
             if owning_buf:
                 PyBuffer_Release(buf)
 
+    def get_buffer(self, sizehint):
+        if self._recv_buffer is None:
+            self._recv_buffer = bytearray(RECV_BUFFER_SIZE)
+            self._recv_view = memoryview(self._recv_buffer)
+        return self._recv_view
+
+    def buffer_updated(self, nbytes):
+        self.idle = 0
+
+        cdef const char* data = PyByteArray_AS_STRING(self._recv_buffer)
+
+        if self.parser_paused:
+            # Keep the data aside until the pipelined requests are served.
+            self._unparsed += data[:nbytes]
+            self.flow.pause_reading()
+            return
+
+        # llhttp keeps its own state between calls, so the receive buffer
+        # is parsed in place and can be reused for the next read as is.
+        self._execute(data, <size_t>nbytes)
+
+    cdef _execute(self, const char* data, size_t data_len):
+        cdef:
+            cparser.llhttp_errno_t err
+            const char* err_pos
+
+        err = cparser.llhttp_execute(self._cparser, data, data_len)
+        # Keep a header that continues in the next read.
+        self._save_span()
+
+        if self._cparser.upgrade == 1 and err == cparser.HPE_PAUSED_UPGRADE:
+            err_pos = cparser.llhttp_get_error_pos(self._cparser)
+
+            # Immediately free the parser from "error" state, simulating
+            # http-parser behavior here because 1) we never had the API to
+            # allow users manually "resume after upgrade", and 2) the use
+            # case for resuming parsing is very rare.
+            cparser.llhttp_resume_after_upgrade(self._cparser)
+
+            # The err_pos here is specific for the input buf. So if we ever
+            # switch to the llhttp behavior (re-raise HttpParserUpgrade for
+            # successive calls to feed_data() until resume_after_upgrade is
+            # called), we have to store the result and keep our own state.
+            #raise HttpParserUpgrade(err_pos - data)
+            self.handle_upgrade()
+            return
+
+        if err == cparser.HPE_PAUSED:
+            # The pipeline is full or a body chunk is waiting for the
+            # application, the rest of the data is parsed once the parser
+            # is resumed.
+            err_pos = cparser.llhttp_get_error_pos(self._cparser)
+            self._unparsed = data[err_pos - data:data_len]
+            self.flow.pause_reading()
+            return
+
+        if err != cparser.HPE_OK and isinstance(
+            self._last_error,
+            (HttpParserURLTooLongError, HttpParserHeadersTooLargeError),
+        ):
+            # A request limit was exceeded, answer without parsing further.
+            ex, self._last_error = self._last_error, None
+            if isinstance(ex, HttpParserURLTooLongError):
+                response = URI_TOO_LONG
+            else:
+                response = REQUEST_HEADER_FIELDS_TOO_LARGE
+            self.logger.warning("Invalid HTTP request received: %s.", ex)
+            if not self._transport.is_closing():
+                self._write_output()
+                self._transport.write(response)
+                self._transport.close()
+            return
+
         if err != cparser.HPE_OK:
             ex = parser_error_from_errno(
                 self._cparser,
@@ -515,51 +1132,149 @@ cdef class Protocol:
             msg = "Invalid HTTP request received."
             self.logger.warning(msg, exc_info=ex)
             if not self._transport.is_closing():
+                self._write_output()
                 self._transport.close()
 
     # ASGI exception wrapper
     async def run_asgi(self):
-        while not self.disconnected:
-            try:
-                run_app = await self.run_asgi_event
-                if not run_app:
-                    return
-                
-                self.run_asgi_event = self._loop.create_future()
-
-                result = await self.app(self._scope, self.receive, self.send)
-            except asyncio.CancelledError:
-                return
-            except BaseException as exc:
-                msg = "Exception in ASGI application\n"
-                self.logger.error(msg, exc_info=exc)
-                if not self.response_started:
-                    await self.send_500_response()
-                else:
-                    if not self._transport.is_closing():
-                        self._transport.close()
-                return
-            else:
-                if result is not None:
-                    msg = "ASGI callable should return None, but returned '%s'."
-                    self.logger.error(msg, result)
-                    if not self._transport.is_closing():
-                        self._transport.close()
-                    return
-                elif not self.response_started and not self.disconnected:
-                    msg = "ASGI callable returned without starting response."
-                    self.logger.error(msg)
-                    await self.send_500_response()
+        try:
+            while self.request_ready and not self.disconnected:
+                self.request_ready = False
+                try:
+                    result = await self.app(self._scope, self.receive, self.send)
+                except asyncio.CancelledError:
                     return
-                elif not self.response_complete and not self.disconnected:
-                    msg = "ASGI callable returned without completing response."
-                    self.logger.error(msg)
-                    if not self._transport.is_closing():
-                        self._transport.close()
+                except BaseException as exc:
+                    if self.body_rejected and self.response_complete:
+                        # The application was cut off by the body limit, and
+                        # failed on the disconnect it received instead.
+                        if not self.keep_alive:
+                            return
+                        self.request_processing = False
+                        self._next_request()
+                        continue
+                    msg = "Exception in ASGI application\n"
+                    self.logger.error(msg, exc_info=exc)
+                    if not self.response_started:
+                        await self.send_500_response()
+                    else:
+                        if not self._transport.is_closing():
+                            self._write_output()
+                            self._transport.close()
                     return
                 else:
-                    if not self.keep_alive:
+                    if result is not None:
+                        msg = "ASGI callable should return None, but returned '%s'."
+                        self.logger.error(msg, result)
+                        if not self._transport.is_closing():
+                            self._write_output()
+                            self._transport.close()
+                        return
+                    elif not self.response_started and not self.disconnected:
+                        msg = "ASGI callable returned without starting response."
+                        self.logger.error(msg)
+                        await self.send_500_response()
                         return
+                    elif not self.response_complete and not self.disconnected:
+                        msg = "ASGI callable returned without completing response."
+                        self.logger.error(msg)
+                        if not self._transport.is_closing():
+                            self._write_output()
+                            self._transport.close()
+                        return
+                    else:
+                        if not self.keep_alive:
+                            return
+                        if self.body_rejected:
+                            self.request_processing = False
+                        self._next_request()
+        finally:
+            # The next request on this connection starts a new task, idle
+            # keep-alive connections don't hold on to one.
+            self.worker = None
+            self._maybe_release()
+
+    cdef _start_worker(self):
+        self.worker = self._loop.create_task(self.run_asgi())
+        self.tasks.add(self.worker)
+        self.worker.add_done_callback(self.tasks.discard)
+
+    cdef inline _drop_body(self):
+        self.flow.release_buffered(self.body_size)
+        self.body = deque()
+        self.body_size = 0
+
+    cdef inline _set_message_ready(self):
+        self.message_ready = True
+        if self.message_event is not None and not self.message_event.done():
+            self.message_event.set_result(True)
+
+    cdef _reject_body(self, bint app_started, int status_code=413):
+        # The request body is over the limit, or refused by the expect hook.
+        # The client gets an error in place of the application's response,
+        # and the rest of the body is dropped as it arrives so that the
+        # connection can be kept alive.
+        cdef tuple block
+        cdef bint close
+        cdef bytes body
+
+        self._drop_body()
+        self.body_rejected = True
+        self.expect_100_continue = False
+
+        if self.response_started:
+            # Too late for a 413.
+            self.logger.warning("Request body exceeded the size limit.")
+            if not self._transport.is_closing():
+                self._write_output()
+                self._transport.close()
+            return
+
+        if self.access_log:
+            self.access_logger.info(
+                '%s - "%s %s HTTP/%s" %d',
+                get_client_addr(self._scope),
+                self._scope["method"],
+                get_path_with_query_string(self._scope),
+                self._scope["http_version"],
+                status_code,
+            )
+
+        if status_code == 413:
+            body = b"Payload Too Large"
+        else:
+            try:
+                body = http.HTTPStatus(status_code).phrase.encode()
+            except ValueError:
+                body = b""
+        close = not self.keep_alive or CLOSE_HEADER in self._scope["headers"]
+        block = get_header_block(
+            status_code,
+            self.server_state.default_headers,
+            (
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+            ),
+            close,
+            False,
+        )
+        self._output.extend((block[0], body))
+        self.response_started = self.response_complete = True
+        if app_started:
+            # The application is handed a disconnect, the next request
+            # waits until it returns.
+            self._set_message_ready()
+        else:
+            self.request_ready = False
+            self.request_processing = False
+        self.server_state.total_requests += 1
+
+        if not block[3]:
+            self.keep_alive = False
+            self._write_output()
+            self._transport.close()
+        else:
+            self._schedule_flush()
 
     #            self.on_response = None
 
@@ -583,16 +1298,14 @@ cdef class Protocol:
     async def send(self, dict message):
         cdef str message_type = message["type"]
         cdef int status_code
-        cdef list headers
-        cdef bytes name
-        cdef bytes value
+        cdef tuple block
+        cdef list output
         cdef str msg
-        cdef list content
 
         if self.flow.write_paused and not self.disconnected:
             await self.flow.drain()
 
-        if self.disconnected:
+        if self.disconnected or self.body_rejected:
             return
 
         if not self.response_started:
@@ -605,10 +1318,6 @@ cdef class Protocol:
             self.expect_100_continue = False
 
             status_code = message["status"]
-            headers = self.default_headers + list(message.get("headers", []))
-
-            if CLOSE_HEADER in self._scope["headers"] and CLOSE_HEADER not in headers:
-                headers = headers + [CLOSE_HEADER]
 
             if self.access_log:
                 self.access_logger.info(
@@ -620,61 +1329,48 @@ cdef class Protocol:
                     status_code,
                 )
 
-            # Write response status line and headers
-            self._transport.write(STATUS_LINE[status_code])
-
-            for name, value in headers:
-                # Should be active only in development mode.
-                # if HEADER_RE.search(name):
-                #     raise RuntimeError("Invalid HTTP header name.")
-                # if HEADER_VALUE_RE.search(value):
-                #     raise RuntimeError("Invalid HTTP header value.")
-
-                name = name.lower()
-                if name == b"content-length" and self.chunked_encoding is None:
-                    self.expected_content_length = int(value)
-                    self.chunked_encoding = False
-                elif name == b"transfer-encoding" and value.lower() == b"chunked":
-                    self.expected_content_length = 0
-                    self.chunked_encoding = True
-                elif name == b"connection" and value.lower() == b"close":
-                    self.keep_alive = False
-                self._transport.writelines((name, b": ", value, b"\r\n"))
-
-            if (
-                    self.chunked_encoding is None
-                    and self._scope["method"] != "HEAD"
-                    and status_code not in (204, 304)
-            ):
-                # Neither content-length nor transfer-encoding specified
-                self.chunked_encoding = True
-                self._transport.write(b"transfer-encoding: chunked\r\n\r\n")
-            else:
-                self._transport.write(b"\r\n")
+            # Stage response status line and headers, they are written
+            # together with the first body chunk.
+            block = get_header_block(
+                status_code,
+                self.server_state.default_headers,
+                message.get("headers", ()),
+                CLOSE_HEADER in self._scope["headers"],
+                self._scope["method"] == "HEAD",
+            )
+            self._output.append(block[0])
+            self._schedule_flush()
+            self.expected_content_length = block[1]
+            self.chunked_encoding = block[2]
+            if not block[3]:
+                self.keep_alive = False
 
         elif not self.response_complete:
             # Sending response body
-            if message_type != "http.response.body":
+            if (
+                message_type != "http.response.body"
+                and message_type != "http.response.zerocopysend"
+            ):
                 msg = "Expected ASGI message 'http.response.body', but got '%s'."
                 raise RuntimeError(msg % message_type)
 
             body = message.get("body", b"")
             more_body = message.get("more_body", False)
 
+            output = self._output
+
             # Write response body
             if self._scope["method"] == "HEAD":
                 self.expected_content_length = 0
+            elif message_type == "http.response.zerocopysend":
+                await self._send_file(message, more_body)
             elif self.chunked_encoding:
                 if body and not more_body:
-                    self._transport.writelines(
-                        (b"%x\r\n" % len(body), body, b"\r\n0\r\n\r\n")
-                    )
+                    output.extend((b"%x\r\n" % len(body), body, b"\r\n0\r\n\r\n"))
                 elif body and more_body:
-                    self._transport.writelines(
-                        (b"%x\r\n" % len(body), body, b"\r\n")
-                    )
+                    output.extend((b"%x\r\n" % len(body), body, b"\r\n"))
                 elif not body and not more_body:
-                    self._transport.write(b"0\r\n\r\n")
+                    output.append(b"0\r\n\r\n")
             else:
                 num_bytes = len(body)
                 if self.expected_content_length:
@@ -682,7 +1378,19 @@ cdef class Protocol:
                         raise RuntimeError("Response content longer than Content-Length")
                     else:
                         self.expected_content_length -= num_bytes
-                self._transport.write(body)
+                if num_bytes:
+                    output.append(body)
+
+            if self.write_batch_latency is None:
+                self._write_output()
+            else:
+                # Staged output counts against the write buffer limits, past
+                # them it goes to the transport, which pauses the writing.
+                self._output_size += len(body)
+                if self._output_size > self.write_high_water:
+                    self._write_output()
+                else:
+                    self._schedule_flush()
 
             # Handle response completion
             if not more_body:
@@ -691,49 +1399,202 @@ cdef class Protocol:
                 self.response_complete = True
                 self.request_processing = False
 
-                if self.flow.read_paused:
-                    self.flow.resume_reading()
+                self._maybe_resume_reading()
 
-                if not self.message_event.done():
-                    self.message_event.set_result(True)
+                self._set_message_ready()
 
                 if not self.keep_alive and not self._transport.is_closing():
+                    self._write_output()
                     if self.flow.write_paused:
                         await self.flow.drain()
                     self._transport.close()
 
                 self.server_state.total_requests += 1
-                self.idle = self.server_state.time
+                self.idle = time()
+                if self.keep_alive and not self.timer_armed:
+                    # A weak reference keeps closed instances reusable. One
+                    # entry per connection, it is moved on by on_timer().
+                    self.timer_armed = True
+                    self.server_state.timers.schedule(
+                        (ref(self), self.generation),
+                        self.idle + self.timeout_keep_alive,
+                    )
 
         else:
             # Response already sent
             msg = "Unexpected ASGI message '%s' sent, after response already completed."
             raise RuntimeError(msg % message_type)
 
+    async def _send_file(self, dict message, bint more_body):
+        cdef object file = message["file"]
+        cdef int fd = file.fileno()
+        cdef object offset = message.get("offset")
+        cdef object count = message.get("count")
+
+        if offset is None:
+            offset = os.lseek(fd, 0, os.SEEK_CUR)
+        if count is None:
+            count = os.fstat(fd).st_size - offset
+
+        if self.chunked_encoding:
+            if count:
+                self._output.append(b"%x\r\n" % count)
+        elif self.expected_content_length:
+            if count > self.expected_content_length:
+                raise RuntimeError("Response content longer than Content-Length")
+            else:
+                self.expected_content_length -= count
+
+        # The file is written by the transport, everything staged so far
+        # has to go out before it.
+        self._write_output()
+
+        if count:
+            if self.flow.write_paused:
+                await self.flow.drain()
+            if self.disconnected:
+                return
+            try:
+                await self._loop.sendfile(
+                    self._transport, file, offset, count, fallback=False
+                )
+            except (NotImplementedError, asyncio.SendfileNotAvailableError):
+                # TLS transports and loops without sendfile support, such as
+                # uvloop, get the file in chunks read off the event loop.
+                await self._send_file_chunks(fd, offset, count)
+                file.seek(offset + count)
+
+        if self.chunked_encoding:
+            if count:
+                self._output.append(b"\r\n")
+            if not more_body:
+                self._output.append(b"0\r\n\r\n")
+
+    async def _send_file_chunks(self, int fd, offset, count):
+        cdef bytes chunk
+
+        while count > 0:
+            chunk = await self._loop.run_in_executor(
+                None, os.pread, fd, min(count, SENDFILE_CHUNK_SIZE), offset
+            )
+            if not chunk:
+                raise RuntimeError("File is shorter than the requested count")
+            if self._transport.is_closing():
+                return
+            self._transport.write(chunk)
+            offset += len(chunk)
+            count -= len(chunk)
+            if self.flow.write_paused:
+                await self.flow.drain()
+
+    cdef _write_output(self):
+        cdef list output = self._output
+
+        if output:
+            self._output = []
+            self._output_size = 0
+            if not self._transport.is_closing():
+                self._transport.writelines(output)
+
+    cdef inline _schedule_flush(self):
+        cdef list pending
+
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            if self.write_batch_latency:
+                self._loop.call_later(
+                    self.write_batch_latency, self._flush_output, self.generation
+                )
+            else:
+                # A single callback per event loop iteration flushes all the
+                # connections, usually there is nothing left to write.
+                pending = self.server_state.pending_flush
+                if not pending:
+                    self._loop.call_soon(_flush_pending, pending)
+                pending.append((self, self.generation))
+
+    def _flush_output(self, generation):
+        # Output is only held back until the end of the event loop iteration,
+        # or for at most write_batch_latency seconds when batching is enabled.
+        if generation != self.generation:
+            return
+        self._flush_scheduled = False
+        self._write_output()
+        self._maybe_release()
+
     async def receive(self):
         if self.expect_100_continue and not self._transport.is_closing():
-            self._transport.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            self._write_output()
+            self._transport.write(CONTINUE_RESPONSE)
             self.expect_100_continue = False
 
         if not self.disconnected and not self.response_complete:
-            if self.flow.read_paused:
-                self.flow.resume_reading()
-            await self.message_event
-            self.message_event = self._loop.create_future()
+            if self.body_paused and self.body_size < self.receive_chunk_size:
+                self._resume_parser()
+            self._maybe_resume_reading()
+            if not self.message_ready:
+                self.message_event = self._loop.create_future()
+                await self.message_event
+                self.message_event = None
+            self.message_ready = False
 
         if self.disconnected or self.response_complete:
             message = {"type": "http.disconnect"}
         else:
+            if 0 < self.receive_chunk_size < self.body_size:
+                # Hand out at most one chunk per event, the rest is picked up
+                # by the next call.
+                body = b"".join(self.body)
+                self.body = deque((body[self.receive_chunk_size:],))
+                body = body[:self.receive_chunk_size]
+                self.body_size -= len(body)
+                self.flow.release_buffered(len(body))
+                self.message_ready = True
+                more_body = True
+            elif self.stream_request_body and len(self.body) > 1:
+                # Hand out one chunk per event, the next call picks up
+                # the rest without waiting for more data.
+                body = self.body.popleft()
+                self.body_size -= len(body)
+                self.flow.release_buffered(len(body))
+                if PyMemoryView_Check(body):
+                    body = bytes(body)
+                self.message_ready = True
+                more_body = True
+            else:
+                # Joining once here avoids re-copying the whole buffer
+                # for each chunk received from the transport.
+                body = b"".join(self.body)
+                self._drop_body()
+                more_body = self.more_body
             message = {
                 "type": "http.request",
-                "body": self.body,
-                "more_body": self.more_body,
+                "body": body,
+                "more_body": more_body,
             }
-            self.body = b""
 
         return message
 
 
+class BufferedProtocol(Protocol, asyncio.BufferedProtocol):
+    """
+    Reads straight into a receive buffer owned by the connection instead
+    of getting a new bytes object from the transport for every read.
+    """
+
+    __slots__ = ()
+
+
+def _flush_pending(list pending):
+    cdef Protocol protocol
+    cdef list protocols = pending[:]
+
+    # Connections staging output from here on get the next iteration's call.
+    pending.clear()
+    for protocol, generation in protocols:
+        protocol._flush_output(generation)
+
+
 cdef inline int cb_on_message_begin(cparser.llhttp_t* parser) except -1:
     cdef Protocol pyparser = < Protocol > parser.data
     try:
@@ -749,7 +1610,22 @@ cdef inline int cb_on_url(cparser.llhttp_t* parser,
                    const char *at, size_t length) except -1:
     cdef Protocol pyparser = <Protocol>parser.data
     try:
-        pyparser._on_url(at[:length])
+        pyparser._on_url_fragment(at[:length])
+    except BaseException as ex:
+        cparser.llhttp_set_error_reason(parser, "`on_url` callback error")
+        pyparser._last_error = ex
+        return cparser.HPE_USER
+    else:
+        return 0
+
+
+cdef inline int cb_on_url_complete(cparser.llhttp_t* parser) except -1:
+    cdef Protocol pyparser = <Protocol>parser.data
+    cdef bytes url = pyparser._current_url
+    try:
+        # The URL may arrive in several fragments when it straddles reads.
+        pyparser._current_url = None
+        pyparser._on_url(url)
     except BaseException as ex:
         cparser.llhttp_set_error_reason(parser, "`on_url` callback error")
         pyparser._last_error = ex
@@ -761,8 +1637,24 @@ cdef inline int cb_on_url(cparser.llhttp_t* parser,
 cdef inline int cb_on_header_field(cparser.llhttp_t* parser,
                             const char *at, size_t length) except -1:
     cdef Protocol pyparser = <Protocol>parser.data
+    if pyparser._last_error is not None:
+        # Raised by one of the *_complete callbacks, llhttp ignores their
+        # return value so parsing is stopped here instead.
+        return cparser.HPE_USER
+    try:
+        pyparser._on_header_span(at, length)
+    except BaseException as ex:
+        cparser.llhttp_set_error_reason(parser, "`on_header_field` callback error")
+        pyparser._last_error = ex
+        return cparser.HPE_USER
+    else:
+        return 0
+
+
+cdef inline int cb_on_header_field_complete(cparser.llhttp_t* parser) except -1:
+    cdef Protocol pyparser = <Protocol>parser.data
     try:
-        pyparser._on_header_field(at[:length])
+        pyparser._on_header_field_complete()
     except BaseException as ex:
         cparser.llhttp_set_error_reason(parser, "`on_header_field` callback error")
         pyparser._last_error = ex
@@ -774,8 +1666,24 @@ cdef inline int cb_on_header_field(cparser.llhttp_t* parser,
 cdef inline int cb_on_header_value(cparser.llhttp_t* parser,
                             const char *at, size_t length) except -1:
     cdef Protocol pyparser = <Protocol>parser.data
+    if pyparser._last_error is not None:
+        # Raised by one of the *_complete callbacks, llhttp ignores their
+        # return value so parsing is stopped here instead.
+        return cparser.HPE_USER
+    try:
+        pyparser._on_header_span(at, length)
+    except BaseException as ex:
+        cparser.llhttp_set_error_reason(parser, "`on_header_value` callback error")
+        pyparser._last_error = ex
+        return cparser.HPE_USER
+    else:
+        return 0
+
+
+cdef inline int cb_on_header_value_complete(cparser.llhttp_t* parser) except -1:
+    cdef Protocol pyparser = <Protocol>parser.data
     try:
-        pyparser._on_header_value(at[:length])
+        pyparser._on_header_value_complete()
     except BaseException as ex:
         cparser.llhttp_set_error_reason(parser, "`on_header_value` callback error")
         pyparser._last_error = ex
@@ -786,6 +1694,8 @@ cdef inline int cb_on_header_value(cparser.llhttp_t* parser,
 
 cdef inline int cb_on_headers_complete(cparser.llhttp_t* parser) except -1:
     cdef Protocol pyparser = <Protocol>parser.data
+    if pyparser._last_error is not None:
+        return cparser.HPE_USER
     try:
         pyparser._on_headers_complete()
     except BaseException as ex:
@@ -801,14 +1711,22 @@ cdef inline int cb_on_headers_complete(cparser.llhttp_t* parser) except -1:
 cdef inline int cb_on_body(cparser.llhttp_t* parser,
                     const char *at, size_t length) except -1:
     cdef Protocol pyparser = <Protocol>parser.data
+    cdef Py_ssize_t offset
     try:
-        pyparser._on_body(at[:length])
+        if pyparser._data is not None:
+            offset = at - pyparser._data_base
+            pyparser._on_body(pyparser._data[offset:offset + <Py_ssize_t>length])
+        else:
+            pyparser._on_body(at[:length])
     except BaseException as ex:
         cparser.llhttp_set_error_reason(parser, "`on_body` callback error")
         pyparser._last_error = ex
         return cparser.HPE_USER
     else:
-        return 0
+        if pyparser.body_paused:
+            return cparser.HPE_PAUSED
+        else:
+            return 0
 
 
 cdef inline int cb_on_message_complete(cparser.llhttp_t* parser) except -1:
@@ -819,7 +1737,10 @@ cdef inline int cb_on_message_complete(cparser.llhttp_t* parser) except -1:
         pyparser._last_error = ex
         return -1
     else:
-        return 0
+        if pyparser.parser_paused:
+            return cparser.HPE_PAUSED
+        else:
+            return 0
 
 
 cdef inline int cb_on_chunk_header(cparser.llhttp_t* parser) except -1:
@@ -868,3 +1789,18 @@ cdef inline parser_error_from_errno(cparser.llhttp_t* parser, cparser.llhttp_err
         cls = HttpParserError
 
     return cls(reason.decode('latin-1'))
+
+
+# The callbacks are the same for every connection, so all parsers share
+# a single settings struct.
+cdef cparser.llhttp_settings_t _csettings
+cparser.llhttp_settings_init(&_csettings)
+_csettings.on_header_field = cb_on_header_field
+_csettings.on_header_value = cb_on_header_value
+_csettings.on_header_field_complete = cb_on_header_field_complete
+_csettings.on_header_value_complete = cb_on_header_value_complete
+_csettings.on_url = cb_on_url
+_csettings.on_url_complete = cb_on_url_complete
+_csettings.on_headers_complete = cb_on_headers_complete
+_csettings.on_message_complete = cb_on_message_complete
+_csettings.on_body = cb_on_body
@@ -0,0 +1,168 @@
+"""
+Support for SO_REUSEPORT listening sockets, where every worker process listens
+on a socket of its own and the kernel balances new connections between them.
+"""
+import ctypes
+import socket
+import sys
+from typing import Dict, FrozenSet, List, Optional, Set
+
+# Not exposed by the socket module, see <asm-generic/socket.h>.
+SO_ATTACH_REUSEPORT_CBPF = 51
+
+# Classic BPF opcodes and ancillary data offset, see <linux/filter.h>.
+BPF_LD_W_ABS = 0x20
+BPF_ALU_MOD_K = 0x94
+BPF_JMP_JEQ_K = 0x15
+BPF_RET_K = 0x06
+BPF_RET_A = 0x16
+SKF_AD_CPU = 0xFFFFF000 + 36
+
+
+class SockFilter(ctypes.Structure):
+    _fields_ = [
+        ("code", ctypes.c_uint16),
+        ("jt", ctypes.c_uint8),
+        ("jf", ctypes.c_uint8),
+        ("k", ctypes.c_uint32),
+    ]
+
+
+class SockFprog(ctypes.Structure):
+    _fields_ = [
+        ("len", ctypes.c_uint16),
+        ("filter", ctypes.POINTER(SockFilter)),
+    ]
+
+
+def supports_reuse_port() -> bool:
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+def supports_cpu_program() -> bool:
+    return sys.platform == "linux"
+
+
+def get_cpu_sockets(worker_cpus: List[Set[int]]) -> Dict[int, int]:
+    """
+    The index of the socket, and so of the worker, that gets the connections
+    received by each CPU: a worker pinned to that CPU. Workers pinned to the
+    same CPUs share them out round-robin.
+    """
+    sharing: Dict[FrozenSet[int], List[int]] = {}
+    for idx, cpus in enumerate(worker_cpus):
+        sharing.setdefault(frozenset(cpus), []).append(idx)
+
+    cpu_sockets: Dict[int, int] = {}
+    for cpus, workers in sharing.items():
+        for idx, cpu in enumerate(sorted(cpus)):
+            cpu_sockets.setdefault(cpu, workers[idx % len(workers)])
+    return cpu_sockets
+
+
+def attach_cpu_program(
+    sock: socket.socket, count: int, cpu_sockets: Optional[Dict[int, int]] = None
+) -> None:
+    """
+    Hand each new connection to the socket at index `cpu_sockets[cpu]` of
+    the port's reuseport group, or `cpu % count` for the CPUs not listed,
+    where `cpu` is the CPU that received the connection. Sockets are indexed
+    in the order they started listening.
+
+    The program applies to the whole group, attaching it again from another
+    socket of the group replaces it.
+    """
+    filters = [SockFilter(BPF_LD_W_ABS, 0, 0, SKF_AD_CPU)]
+    for cpu, index in sorted((cpu_sockets or {}).items()):
+        # Returns the index if A == cpu, skips to the next CPU otherwise.
+        filters.append(SockFilter(BPF_JMP_JEQ_K, 0, 1, cpu))
+        filters.append(SockFilter(BPF_RET_K, 0, 0, index))
+    filters.append(SockFilter(BPF_ALU_MOD_K, 0, 0, count))
+    filters.append(SockFilter(BPF_RET_A, 0, 0, 0))
+
+    program = (SockFilter * len(filters))(*filters)
+    fprog = SockFprog(len(program), program)
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, bytes(fprog))
+
+
+def listen_group(sock: socket.socket, count: int, backlog: int) -> List[socket.socket]:
+    """
+    `count` sockets listening on the address `sock` is bound to, joining the
+    port's reuseport group in the order they are returned.
+    """
+    sockets = []
+    for _ in range(count):
+        listener = socket.socket(family=sock.family)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind(sock.getsockname())
+        listener.listen(backlog)
+        listener.set_inheritable(True)
+        sockets.append(listener)
+    return sockets
+
+
+class ReuseportGroup:
+    """
+    The listening sockets of the workers on one address, in the port's
+    reuseport group.
+
+    The kernel indexes the group in the order the sockets started listening.
+    A socket leaving the group is replaced by the last one, and a socket
+    listening again is appended. The order is tracked here, so that the CPU
+    program keeps pointing at the right workers.
+    """
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        count: int,
+        backlog: int,
+        cpu_program: bool = False,
+        cpu_sockets: Optional[Dict[int, int]] = None,
+    ) -> None:
+        self.sockets = listen_group(sock, count, backlog)
+        self.backlog = backlog
+        # The worker index of the socket at each position of the group.
+        self.order = list(range(count))
+        self.cpu_program = cpu_program
+        self.cpu_sockets = cpu_sockets
+        self.attach()
+
+    def detach(self, idx: int) -> None:
+        """
+        Take a worker's socket out of the group, while nothing accepts its
+        connections. They go to the other workers instead of waiting.
+        """
+        if idx not in self.order:
+            return
+        self.sockets[idx].shutdown(socket.SHUT_RDWR)
+        position = self.order.index(idx)
+        self.order[position] = self.order[-1]
+        self.order.pop()
+        self.attach()
+
+    def rejoin(self, idx: int) -> None:
+        if idx in self.order:
+            return
+        self.sockets[idx].listen(self.backlog)
+        self.order.append(idx)
+        self.attach()
+
+    def attach(self) -> None:
+        if not self.cpu_program or not self.order:
+            return
+        cpu_sockets = None
+        if self.cpu_sockets is not None:
+            positions = {idx: position for position, idx in enumerate(self.order)}
+            # The CPUs of the workers out of the group are spread over the rest.
+            cpu_sockets = {
+                cpu: positions[idx]
+                for cpu, idx in self.cpu_sockets.items()
+                if idx in positions
+            }
+        attach_cpu_program(self.sockets[self.order[0]], len(self.order), cpu_sockets)
+
+    def close(self) -> None:
+        for sock in self.sockets:
+            sock.close()
@@ -2,6 +2,7 @@ import asyncio
 import logging
 import os
 import platform
+import random
 import signal
 import socket
 import sys
@@ -9,22 +10,24 @@ import threading
 import time
 from email.utils import formatdate
 from functools import partial
+from multiprocessing.connection import Connection
 from types import FrameType
-from typing import TYPE_CHECKING, Any, List, Optional, Set, Tuple, Union
+from typing import TYPE_CHECKING, Any, Callable, List, Optional, Set, Tuple, Union
 
 import click
 
 from esg._handlers.http import handle_http
 from esg.config import Config
+from esg.protocols.http.flow_control import ReadBudget
 from esg.protocols.http.protocol import Protocol
+from esg.reuseport import attach_cpu_program
+from esg.timer_wheel import TimerWheel
 
 if TYPE_CHECKING:
-    from esg.protocols.http.h11_impl import H11Protocol
-    from esg.protocols.http.httptools_impl import HttpToolsProtocol
     from esg.protocols.websockets.websockets_impl import WebSocketProtocol
     from esg.protocols.websockets.wsproto_impl import WSProtocol
 
-    Protocols = Union[H11Protocol, HttpToolsProtocol, WSProtocol, WebSocketProtocol]
+    Protocols = Union[Protocol, WSProtocol, WebSocketProtocol]
 
 if sys.platform != "win32":
     from asyncio import start_unix_server as _start_unix_server
@@ -47,7 +50,17 @@ class ServerState:
     Shared servers state that is available between all protocol instances.
     """
 
-    __slots__ = ["total_requests", "connections", "tasks", "default_headers", "time"]
+    __slots__ = [
+        "total_requests",
+        "connections",
+        "tasks",
+        "default_headers",
+        "time",
+        "timers",
+        "protocol_pool",
+        "read_budget",
+        "pending_flush",
+    ]
 
     def __init__(self) -> None:
         self.total_requests = 0
@@ -55,6 +68,38 @@ class ServerState:
         self.connections: Set["Protocols"] = set()
         self.tasks: Set[asyncio.Task] = set()
         self.default_headers: List[Tuple[bytes, bytes]] = []
+        self.timers = TimerWheel()
+        self.protocol_pool: Optional[ProtocolPool] = None
+        self.read_budget: Optional[ReadBudget] = None
+        self.pending_flush: List[Protocol] = []
+
+
+class ProtocolPool:
+    """
+    Bounded free-list of closed HTTP protocol instances.
+
+    Used as the protocol factory of the listening sockets, new connections
+    get a recycled instance whenever one is available. Instances release
+    themselves once nothing is left to run for their connection.
+    """
+
+    __slots__ = ["factory", "size", "free"]
+
+    def __init__(self, factory: Callable[[], Any], size: int = 256) -> None:
+        self.factory = factory
+        self.size = size
+        self.free: List[Protocol] = []
+
+    def __call__(self) -> Protocol:
+        if self.free:
+            protocol = self.free.pop()
+            protocol.reset()
+            return protocol
+        return self.factory()
+
+    def release(self, protocol: Protocol) -> None:
+        if len(self.free) < self.size:
+            self.free.append(protocol)
 
 
 class Server:
@@ -67,6 +112,8 @@ class Server:
         "last_notified",
         "lifespan",
         "servers",
+        "heartbeat",
+        "max_requests",
     ]
 
     def __init__(self, config: Config) -> None:
@@ -77,8 +124,15 @@ class Server:
         self.should_exit = False
         self.force_exit = False
         self.last_notified = 0.0
-
-    def run(self, sockets: Optional[List[socket.socket]] = None) -> None:
+        self.heartbeat: Optional[Connection] = None
+        self.max_requests = config.limit_max_requests
+
+    def run(
+        self,
+        sockets: Optional[List[socket.socket]] = None,
+        heartbeat: Optional[Connection] = None,
+    ) -> None:
+        self.heartbeat = heartbeat
         self.config.setup_event_loop()
         if sys.version_info >= (3, 7):
             return asyncio.run(self.serve(sockets=sockets))
@@ -93,6 +147,12 @@ class Server:
 
         self.lifespan = config.lifespan_class(config)
 
+        if config.limit_max_requests is not None:
+            # Spread out the restarts of workers started together.
+            self.max_requests = config.limit_max_requests + random.randint(
+                0, config.limit_max_requests_jitter
+            )
+
         self.install_signal_handlers()
 
         message = "Started server process [%d]"
@@ -117,7 +177,16 @@ class Server:
 
         config = self.config
 
-        protocol = partial(Protocol, config=config, server_state=self.server_state)
+        protocol = ProtocolPool(
+            partial(
+                config.http_protocol_class,
+                config=config,
+                server_state=self.server_state,
+            )
+        )
+        self.server_state.protocol_pool = protocol
+        if config.read_memory_budget is not None:
+            self.server_state.read_budget = ReadBudget(config.read_memory_budget)
 
         async def handler(
             reader: asyncio.StreamReader, writer: asyncio.StreamWriter
@@ -130,7 +199,8 @@ class Server:
 
         if sockets is not None:
             # Explicitly passed a list of open sockets.
-            # We use this when the server is run from a Gunicorn worker.
+            # We use this when the server is run from a Gunicorn worker,
+            # or from a worker process with its own sockets with reuse_port.
 
             def _share_socket(sock: socket.SocketType) -> socket.SocketType:
                 # Windows requires the socket be explicitly shared across
@@ -182,6 +252,7 @@ class Server:
                     port=config.port,
                     ssl=config.ssl,
                     backlog=config.backlog,
+                    reuse_port=config.reuse_port or None,
                 )
             except OSError as exc:
                 logger.error(exc)
@@ -190,6 +261,9 @@ class Server:
 
             assert server.sockets is not None
             listeners = server.sockets
+            if config.reuse_port_cbpf:
+                for sock in listeners:
+                    attach_cpu_program(sock, config.workers)
             self.servers = [server]
 
         if sockets is None:
@@ -252,9 +326,16 @@ class Server:
             should_exit = await self.on_tick(counter)
 
     async def on_tick(self, counter: int) -> bool:
+        current_time = time.time()
+
+        # Close the keep-alive connections whose idle deadline has passed.
+        for connection_ref, generation in self.server_state.timers.expire(current_time):
+            connection = connection_ref()
+            if connection is not None:
+                connection.on_timer(current_time, generation)
+
         # Update the default headers, once per second.
         if counter % 10 == 0:
-            current_time = time.time()
             current_date = formatdate(current_time, usegmt=True).encode()
 
             if self.config.date_header:
@@ -262,17 +343,14 @@ class Server:
             else:
                 date_header = []
 
-            for connection in self.server_state.connections.copy():
-                if isinstance(connection, Protocol) and connection.is_expired(
-                    self.server_state.time
-                ):
-                    connection.shutdown()
-
-            self.server_state.time = int(time.time())
+            self.server_state.time = int(current_time)
             self.server_state.default_headers = (
                 date_header + self.config.encoded_headers
             )
 
+            # Tell the supervisor that the event loop is still responsive.
+            self.send_heartbeat()
+
             # Callback to `callback_notify` once every `timeout_notify` seconds.
             if self.config.callback_notify is not None:
                 if current_time - self.last_notified > self.config.timeout_notify:
@@ -282,8 +360,8 @@ class Server:
         # Determine if we should exit.
         if self.should_exit:
             return True
-        if self.config.limit_max_requests is not None:
-            return self.server_state.total_requests >= self.config.limit_max_requests
+        if self.max_requests is not None:
+            return self.server_state.total_requests >= self.max_requests
         return False
 
     async def shutdown(self, sockets: Optional[List[socket.socket]] = None) -> None:
@@ -308,6 +386,8 @@ class Server:
             logger.info(msg)
             while self.server_state.connections and not self.force_exit:
                 await asyncio.sleep(0.1)
+                # Draining is not hanging.
+                self.send_heartbeat()
 
         # Wait for existing tasks to complete.
         if self.server_state.tasks and not self.force_exit:
@@ -315,11 +395,21 @@ class Server:
             logger.info(msg)
             while self.server_state.tasks and not self.force_exit:
                 await asyncio.sleep(0.1)
+                self.send_heartbeat()
 
         # Send the lifespan shutdown event, and wait for application shutdown.
         if not self.force_exit:
             await self.lifespan.shutdown()
 
+    def send_heartbeat(self) -> None:
+        if self.heartbeat is None:
+            return
+        try:
+            self.heartbeat.send_bytes(b"")
+        except OSError:
+            # The supervisor is gone.
+            self.heartbeat = None
+
     def install_signal_handlers(self) -> None:
         if threading.current_thread() is not threading.main_thread():
             # Signals can only be listened to from the main thread.
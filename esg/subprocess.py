@@ -2,33 +2,48 @@
 Some light wrappers around Python's multiprocessing, to deal with cleanly
 starting child processes.
 """
+import gc
 import multiprocessing
 import os
 import sys
-from multiprocessing.context import SpawnProcess
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
 from socket import socket
-from typing import Callable, List, Optional
+from typing import Callable, List, Optional, Set
 
 from esg.config import Config
 
 multiprocessing.allow_connection_pickling()
 spawn = multiprocessing.get_context("spawn")
+fork = (
+    multiprocessing.get_context("fork")
+    if "fork" in multiprocessing.get_all_start_methods()
+    else None
+)
 
 
 def get_subprocess(
     config: Config,
     target: Callable[..., None],
     sockets: List[socket],
-) -> SpawnProcess:
+    cpus: Optional[Set[int]] = None,
+    heartbeat: Optional[Connection] = None,
+    gc_enabled: Optional[bool] = None,
+) -> BaseProcess:
     """
     Called in the parent process, to instantiate a new child process instance.
-    The child is not yet started at this point.
+    The child is not yet started at this point. With `config.preload` it is
+    forked rather than spawned, and shares the application loaded by the parent.
 
     * config - The ESG configuration instance.
     * target - A callable that accepts a list of sockets. In practice this will
                be the `Server.run()` method.
     * sockets - A list of sockets to pass to the server. Sockets are bound once
                 by the parent process, and then passed to the child processes.
+    * cpus - The CPUs to pin the child process to, if any.
+    * heartbeat - The end of a pipe the server writes to while it's running.
+    * gc_enabled - Whether collections were enabled before the parent
+                   disabled them to preload the application.
     """
     # We pass across the stdin fileno, and reopen it in the child process.
     # This is required for some debugging environments.
@@ -43,8 +58,14 @@ def get_subprocess(
         "target": target,
         "sockets": sockets,
         "stdin_fileno": stdin_fileno,
+        "cpus": cpus,
+        "heartbeat": heartbeat,
+        "gc_enabled": gc_enabled,
     }
 
+    if config.preload:
+        assert fork is not None
+        return fork.Process(target=subprocess_started, kwargs=kwargs)
     return spawn.Process(target=subprocess_started, kwargs=kwargs)
 
 
@@ -53,6 +74,9 @@ def subprocess_started(
     target: Callable[..., None],
     sockets: List[socket],
     stdin_fileno: Optional[int],
+    cpus: Optional[Set[int]] = None,
+    heartbeat: Optional[Connection] = None,
+    gc_enabled: Optional[bool] = None,
 ) -> None:
     """
     Called when the child process starts.
@@ -64,13 +88,27 @@ def subprocess_started(
                 by the parent process, and then passed to the child processes.
     * stdin_fileno - The file number of sys.stdin, so that it can be reattached
                      to the child process.
+    * cpus - The CPUs to pin the child process to, if any.
+    * heartbeat - The end of a pipe the server writes to while it's running.
+    * gc_enabled - Whether collections were enabled before the parent
+                   disabled them to preload the application.
     """
     # Re-open stdin.
     if stdin_fileno is not None:
         sys.stdin = os.fdopen(stdin_fileno)
 
+    # Disabled by the parent while preloading the application.
+    if gc_enabled:
+        gc.enable()
+
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+
     # Logging needs to be setup again for each child.
     config.configure_logging()
 
     # Now we can call into `Server.run(sockets=sockets)`
-    target(sockets=sockets)
+    if heartbeat is None:
+        target(sockets=sockets)
+    else:
+        target(sockets=sockets, heartbeat=heartbeat)
@@ -1,15 +1,22 @@
+import gc
 import logging
+import multiprocessing
 import os
 import signal
 import threading
-from multiprocessing.context import SpawnProcess
+import time
+from collections import deque
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
 from socket import socket
 from types import FrameType
-from typing import Callable, List, Optional
+from typing import Callable, Deque, List, Optional, Set
 
 import click
 
+from esg.affinity import worker_cpus
 from esg.config import Config
+from esg.reuseport import ReuseportGroup, get_cpu_sockets
 from esg.subprocess import get_subprocess
 
 HANDLED_SIGNALS = (
@@ -17,9 +24,60 @@ HANDLED_SIGNALS = (
     signal.SIGTERM,  # Unix signal 15. Sent by `kill <pid>`.
 )
 
+# Seconds between two checks of the workers.
+SUPERVISE_INTERVAL = 0.5
+
+# Delay before respawning a crashed worker, doubled on every crash in a row.
+RESTART_BACKOFF_MIN = 0.5
+RESTART_BACKOFF_MAX = 30.0
+
+# Seconds a new worker gets to become ready during a reload, unless
+# `timeout_worker_heartbeat` is set.
+RELOAD_READY_TIMEOUT = 60.0
+
 logger = logging.getLogger("esg.error")
 
 
+def get_rss(pid: int) -> Optional[int]:
+    """
+    Resident set size of a process in bytes, None when it can't be read.
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Worker:
+    """
+    A worker slot, its process is replaced whenever it exits.
+    """
+
+    __slots__ = [
+        "cpus",
+        "sockets",
+        "process",
+        "heartbeat",
+        "started",
+        "last_heartbeat",
+        "ready",
+        "failures",
+        "restart_at",
+    ]
+
+    def __init__(self, sockets: List[socket], cpus: Optional[Set[int]] = None) -> None:
+        self.cpus = cpus
+        self.sockets = sockets
+        self.process: Optional[BaseProcess] = None
+        self.heartbeat: Optional[Connection] = None
+        self.started = 0.0
+        self.last_heartbeat = 0.0
+        self.ready = False
+        self.failures = 0
+        self.restart_at = 0.0
+
+
 class Multiprocess:
     def __init__(
         self,
@@ -30,19 +88,37 @@ class Multiprocess:
         self.config = config
         self.target = target
         self.sockets = sockets
-        self.processes: List[SpawnProcess] = []
+        self.processes: List[BaseProcess] = []
+        self.workers: List[Worker] = []
+        self.retiring: List[BaseProcess] = []
+        self.gc_enabled: Optional[bool] = None
+        self.groups: List[ReuseportGroup] = []
+        # The workers a reload has yet to replace, and the one it is replacing
+        # with the state of its previous process, until the deadline.
+        self.reload_pending: Deque[Worker] = deque()
+        self.replacing: Optional[Worker] = None
+        self.replaced: tuple = ()
+        self.reload_deadline = 0.0
         self.should_exit = threading.Event()
+        self.should_reload = False
         self.pid = os.getpid()
 
     def signal_handler(self, sig: signal.Signals, frame: FrameType) -> None:
         """
         A signal handler that is registered with the parent process.
         """
-        self.should_exit.set()
+        if sig == getattr(signal, "SIGHUP", None):
+            self.should_reload = True
+        else:
+            self.should_exit.set()
 
     def run(self) -> None:
         self.startup()
-        self.should_exit.wait()
+        while not self.should_exit.wait(SUPERVISE_INTERVAL):
+            if self.should_reload:
+                self.should_reload = False
+                self.reload()
+            self.supervise()
         self.shutdown()
 
     def startup(self) -> None:
@@ -54,18 +130,285 @@ class Multiprocess:
 
         for sig in HANDLED_SIGNALS:
             signal.signal(sig, self.signal_handler)
+        if hasattr(signal, "SIGHUP"):  # pragma: py-win32
+            signal.signal(signal.SIGHUP, self.signal_handler)
+
+        if self.config.preload:
+            self.preload()
+
+        cpus: List[Optional[Set[int]]] = [None] * self.config.workers
+        if self.config.cpu_affinity:
+            cpus = list(worker_cpus(self.config.cpu_affinity, self.config.workers))
+
+        sockets = [self.sockets] * self.config.workers
+        if self.config.reuse_port:
+            sockets = self.listen_reuse_port(cpus)
 
         for idx in range(self.config.workers):
-            process = get_subprocess(
-                config=self.config, target=self.target, sockets=self.sockets
+            worker = Worker(sockets[idx], cpus[idx])
+            self.workers.append(worker)
+            self.spawn(worker)
+
+        if self.gc_enabled:
+            gc.enable()
+
+    def listen_reuse_port(self, cpus: List[Optional[Set[int]]]) -> List[List[socket]]:
+        """
+        The listening sockets of each worker, on the addresses of the parent's.
+
+        They are listened in worker order, the order of the port's reuseport
+        group the CPU program indexes, and kept open here so that a replaced
+        worker takes over its predecessor's sockets and place in the group.
+        A crashed worker's sockets leave the group until it is restarted.
+        With pinned workers, the CPU program hands connections to the worker
+        pinned to the CPU that received them.
+        """
+        config = self.config
+        cpu_sockets = None
+        if config.cpu_affinity:
+            cpu_sockets = get_cpu_sockets(
+                [worker_cpus or set() for worker_cpus in cpus]
             )
-            process.start()
-            self.processes.append(process)
+
+        self.groups = [
+            ReuseportGroup(
+                sock,
+                config.workers,
+                config.backlog,
+                cpu_program=config.reuse_port_cbpf,
+                cpu_sockets=cpu_sockets,
+            )
+            for sock in self.sockets
+        ]
+        return [
+            [group.sockets[idx] for group in self.groups]
+            for idx in range(config.workers)
+        ]
+
+    def spawn(self, worker: Worker) -> None:
+        for group in self.groups:
+            group.rejoin(self.workers.index(worker))
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = get_subprocess(
+            config=self.config,
+            target=self.target,
+            sockets=worker.sockets,
+            cpus=worker.cpus,
+            heartbeat=writer,
+            gc_enabled=self.gc_enabled,
+        )
+        process.start()
+        writer.close()
+
+        worker.process = process
+        worker.heartbeat = reader
+        worker.started = worker.last_heartbeat = time.monotonic()
+        worker.ready = False
+        self.processes = [
+            worker.process for worker in self.workers if worker.process is not None
+        ]
+
+    def supervise(self) -> None:
+        """
+        Replace the workers that exited, hung or outgrew the memory limit, and
+        carry on a reload.
+        """
+        now = time.monotonic()
+        config = self.config
+        self.advance_reload(now)
+
+        for worker in self.workers:
+            if worker is self.replacing:
+                continue
+            process = worker.process
+            if process is None:
+                if now >= worker.restart_at:
+                    self.spawn(worker)
+                continue
+
+            self.read_heartbeat(worker, now)
+
+            if process.exitcode is not None:
+                self.reap(worker, now)
+                continue
+
+            # Not before the first heartbeat, which follows the application's
+            # startup however long it takes.
+            timeout = config.timeout_worker_heartbeat
+            if (
+                timeout is not None
+                and worker.ready
+                and now - worker.last_heartbeat > timeout
+            ):
+                logger.error(
+                    "Worker process [%d] sent no heartbeat for %ds, killing it.",
+                    process.pid,
+                    timeout,
+                )
+                process.kill()
+                continue
+
+            if config.limit_worker_memory is not None and worker.ready:
+                rss = get_rss(process.pid)  # type: ignore[arg-type]
+                if rss is not None and rss > config.limit_worker_memory:
+                    logger.info(
+                        "Worker process [%d] uses %d bytes of memory, replacing it.",
+                        process.pid,
+                        rss,
+                    )
+                    # Stopped gracefully, next to its replacement.
+                    process.terminate()
+                    self.retiring.append(process)
+                    self.spawn(worker)
+
+        for process in self.retiring:
+            if process.exitcode is not None:
+                process.join()
+        self.retiring = [
+            process for process in self.retiring if process.exitcode is None
+        ]
+
+    def read_heartbeat(self, worker: Worker, now: float) -> None:
+        assert worker.heartbeat is not None
+        try:
+            while worker.heartbeat.poll():
+                worker.heartbeat.recv_bytes()
+                worker.last_heartbeat = now
+                worker.ready = True
+        except EOFError:
+            pass
+
+    def reload(self) -> None:
+        """
+        Replace the workers one at a time, carried on by `supervise`. Each old
+        worker is stopped only once its replacement is ready, and then drains
+        its connections.
+        """
+        logger.info("Reloading workers")
+        if self.config.preload:
+            logger.warning(
+                "Workers are forked from the preloaded application, "
+                "its code is not reloaded."
+            )
+        # A reload under way starts over once the current replacement is done.
+        self.reload_pending = deque(self.workers)
+
+    def advance_reload(self, now: float) -> None:
+        """
+        Stop the worker being replaced once its replacement is ready, then
+        start replacing the next one.
+        """
+        worker = self.replacing
+        if worker is not None:
+            process = worker.process
+            assert process is not None
+            self.read_heartbeat(worker, now)
+            if not worker.ready:
+                if process.exitcode is None and now <= self.reload_deadline:
+                    return
+                logger.error(
+                    "Worker process [%d] did not become ready, reload aborted.",
+                    process.pid,
+                )
+                process.kill()
+                self.restore(worker, self.replaced)
+                self.reload_pending.clear()
+                return
+
+            old_process, old_heartbeat = self.replaced[0], self.replaced[1]
+            if old_process is not None:
+                assert old_heartbeat is not None
+                # Handled by the server as a graceful shutdown.
+                old_process.terminate()
+                old_heartbeat.close()
+                self.retiring.append(old_process)
+            self.replacing = None
+            if not self.reload_pending:
+                logger.info("Reloaded workers")
+
+        if self.reload_pending:
+            worker = self.reload_pending.popleft()
+            self.replaced = (
+                worker.process,
+                worker.heartbeat,
+                worker.started,
+                worker.last_heartbeat,
+                worker.ready,
+            )
+            self.spawn(worker)
+            self.replacing = worker
+            timeout = self.config.timeout_worker_heartbeat or RELOAD_READY_TIMEOUT
+            self.reload_deadline = now + timeout
+
+    def restore(self, worker: Worker, old: tuple) -> None:
+        """
+        Put back the process a reload was replacing.
+        """
+        self.replacing = None
+        assert worker.process is not None and worker.heartbeat is not None
+        worker.process.terminate()
+        worker.heartbeat.close()
+        self.retiring.append(worker.process)
+        (
+            worker.process,
+            worker.heartbeat,
+            worker.started,
+            worker.last_heartbeat,
+            worker.ready,
+        ) = old
+        self.processes = [
+            worker.process for worker in self.workers if worker.process is not None
+        ]
+
+    def reap(self, worker: Worker, now: float) -> None:
+        assert worker.process is not None and worker.heartbeat is not None
+        process = worker.process
+        process.join()
+        worker.heartbeat.close()
+        worker.process = worker.heartbeat = None
+
+        if process.exitcode == 0 and worker.ready:
+            # Stopped by itself, e.g. after serving limit_max_requests.
+            worker.failures = 0
+            self.spawn(worker)
+            return
+
+        if now - worker.started > RESTART_BACKOFF_MAX:
+            worker.failures = 0
+        delay = min(RESTART_BACKOFF_MIN * 2 ** worker.failures, RESTART_BACKOFF_MAX)
+        worker.failures += 1
+        worker.restart_at = now + delay
+        # New connections go to the other workers in the meantime, rather
+        # than wait in the socket's queue.
+        for group in self.groups:
+            group.detach(self.workers.index(worker))
+        logger.error(
+            "Worker process [%d] died with exit code %s, restarting it in %.1fs.",
+            process.pid,
+            process.exitcode,
+            delay,
+        )
+
+    def preload(self) -> None:
+        """
+        Load the application once, so that the forked workers share it.
+        """
+        # Collections would leave freed holes in pages the workers share, and
+        # the frozen objects are left alone by collections in the workers.
+        self.gc_enabled = gc.isenabled()
+        gc.disable()
+        if not self.config.loaded:
+            self.config.load()
+        gc.freeze()
 
     def shutdown(self) -> None:
-        for process in self.processes:
+        if self.replacing is not None:
+            self.restore(self.replacing, self.replaced)
+        for process in self.processes + self.retiring:
             process.terminate()
             process.join()
+        for group in self.groups:
+            group.close()
 
         message = "Stopping parent process [{}]".format(str(self.pid))
         color_message = "Stopping parent process [{}]".format(
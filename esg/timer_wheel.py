@@ -0,0 +1,55 @@
+import math
+from typing import Any, Dict, List, Optional
+
+
+class TimerWheel:
+    """
+    Deadline index used for connection timeouts.
+
+    Deadlines are grouped into buckets of `resolution` seconds, so expiring
+    them only touches the buckets that are due rather than every connection.
+    Entries are never removed before they are due, instead the caller checks
+    each expired entry against its current state and skips stale ones.
+    """
+
+    __slots__ = ["resolution", "_buckets", "_position"]
+
+    def __init__(self, resolution: float = 0.1) -> None:
+        self.resolution = resolution
+        self._buckets: Dict[int, List[Any]] = {}
+        self._position: Optional[int] = None
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self._buckets.values())
+
+    def schedule(self, item: Any, deadline: float) -> None:
+        # The bucket strictly after the deadline, so that everything in a due
+        # bucket has reached its deadline.
+        index = math.floor(deadline / self.resolution) + 1
+        if self._position is not None and index <= self._position:
+            index = self._position + 1
+
+        bucket = self._buckets.get(index)
+        if bucket is None:
+            self._buckets[index] = [item]
+        else:
+            bucket.append(item)
+
+    def expire(self, now: float) -> List[Any]:
+        due = math.floor(now / self.resolution)
+        position = self._position
+        expired: List[Any] = []
+
+        if position is None or due - position > len(self._buckets):
+            # Only a few buckets to look at compared to the elapsed time.
+            for index in [index for index in self._buckets if index <= due]:
+                expired.extend(self._buckets.pop(index))
+        else:
+            for index in range(position + 1, due + 1):
+                bucket = self._buckets.pop(index, None)
+                if bucket is not None:
+                    expired.extend(bucket)
+
+        if position is None or due > position:
+            self._position = due
+        return expired
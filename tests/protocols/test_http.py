@@ -2,12 +2,16 @@ import asyncio
 import contextlib
 import logging
 import time
+from functools import partial
+from urllib.parse import unquote
 
 import pytest
 
 from esg.config import Config
 from esg.main import ServerState
-from esg.protocols.http.protocol import Protocol
+from esg.protocols.http.flow_control import ReadBudget
+from esg.protocols.http.protocol import COMMON_HEADER_NAMES, BufferedProtocol, Protocol
+from esg.server import ProtocolPool
 from tests.response import Response
 
 
@@ -77,6 +81,22 @@ UPGRADE_REQUEST = b"\r\n".join(
     ]
 )
 
+PIPELINED_REQUESTS = b"".join(
+    [
+        b"\r\n".join([b"GET /one HTTP/1.1", b"Host: example.org", b"", b""]),
+        b"\r\n".join(
+            [
+                b"POST /two HTTP/1.1",
+                b"Host: example.org",
+                b"Content-Length: 18",
+                b"",
+                b'{"hello": "world"}',
+            ]
+        ),
+        b"\r\n".join([b"GET /three HTTP/1.1", b"Host: example.org", b"", b""]),
+    ]
+)
+
 INVALID_REQUEST_TEMPLATE = b"\r\n".join(
     [
         b"%s",
@@ -115,6 +135,9 @@ class MockTransport:
         assert not self.closed
         self.closed = True
 
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.write_buffer_limits = (high, low)
+
     def pause_reading(self):
         self.read_paused = True
 
@@ -151,6 +174,13 @@ class MockLoop(asyncio.AbstractEventLoop):
         return task
         # return MockTask()
 
+    def call_soon(self, callback, *args, context=None):
+        asyncio._set_running_loop(None)
+        try:
+            return self.loop.call_soon(callback, *args, context=context)
+        finally:
+            asyncio._set_running_loop(self)
+
     def call_later(self, delay, callback, *args):
         asyncio._set_running_loop(None)
         try:
@@ -158,6 +188,13 @@ class MockLoop(asyncio.AbstractEventLoop):
         finally:
             asyncio._set_running_loop(self)
 
+    def run_in_executor(self, executor, func, *args):
+        asyncio._set_running_loop(None)
+        try:
+            return self.loop.run_in_executor(executor, func, *args)
+        finally:
+            asyncio._set_running_loop(self)
+
     def run_one(self):
         # tasks, self.tasks = self.tasks, []
         # if tasks:
@@ -278,6 +315,183 @@ def test_head_request(protocol_cls, event_loop):
         assert b"Hello, world" not in protocol.transport.buffer
 
 
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_repeated_response_headers(protocol_cls, event_loop):
+    async def app(scope, receive, send):
+        headers = [(b"content-type", b"text/plain")]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": b"Hello, world"})
+
+    with get_connected_protocol_keep_alive(app, protocol_cls, event_loop) as protocol:
+        responses = []
+        for request in (SIMPLE_GET_REQUEST, SIMPLE_HEAD_REQUEST, SIMPLE_GET_REQUEST):
+            protocol.data_received(request)
+            protocol.loop.run_until_complete(asyncio.sleep(0.01))
+            responses.append(protocol.transport.buffer)
+            protocol.transport.clear_buffer()
+        assert responses[0] == responses[2]
+        assert b"transfer-encoding: chunked" in responses[0]
+        assert b"transfer-encoding: chunked" not in responses[1]
+        assert b"Hello, world" not in responses[1]
+        assert not protocol.transport.is_closing()
+        protocol.shutdown()
+        protocol.loop.run_one()
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_response_headers_generator(protocol_cls, event_loop):
+    async def app(scope, receive, send):
+        headers = (header for header in [(b"x-generated", b"yes")])
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": b"Hello, world"})
+
+    with get_connected_protocol_keep_alive(app, protocol_cls, event_loop) as protocol:
+        for _ in range(2):
+            protocol.data_received(SIMPLE_GET_REQUEST)
+            protocol.loop.run_until_complete(asyncio.sleep(0.01))
+            assert b"x-generated: yes\r\n" in protocol.transport.buffer
+            protocol.transport.clear_buffer()
+        protocol.shutdown()
+        protocol.loop.run_one()
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_response_written_at_once(protocol_cls, event_loop):
+    app = Response("Hello, world", media_type="text/plain")
+
+    with get_connected_protocol(app, protocol_cls, event_loop) as protocol:
+        writes = []
+        transport = protocol.transport
+        transport.write = lambda data: writes.append([data])
+        transport.writelines = lambda lines: writes.append(list(lines))
+        protocol.data_received(SIMPLE_GET_REQUEST)
+        protocol.loop.run_one()
+        assert len(writes) == 1
+        assert writes[0][0].startswith(b"HTTP/1.1 200 OK")
+        assert writes[0][-1] == b"Hello, world"
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_response_start_flushed_without_body(protocol_cls, event_loop):
+    body_ready = asyncio.Event()
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await body_ready.wait()
+        await send({"type": "http.response.body", "body": b"Hello, world"})
+
+    with get_connected_protocol(app, protocol_cls, event_loop) as protocol:
+        protocol.data_received(SIMPLE_GET_REQUEST)
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert protocol.transport.buffer.startswith(b"HTTP/1.1 200 OK")
+        assert b"Hello, world" not in protocol.transport.buffer
+        body_ready.set()
+        protocol.loop.run_one()
+        assert protocol.transport.buffer.endswith(b"c\r\nHello, world\r\n0\r\n\r\n")
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_response_start_flushed_once_per_iteration(protocol_cls, event_loop):
+    body_ready = event_loop.create_future()
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await body_ready
+        await send({"type": "http.response.body", "body": b"Hello, world"})
+
+    loop = MockLoop(event_loop)
+    asyncio._set_running_loop(loop)
+    callbacks = []
+
+    def call_soon(callback, *args):
+        callbacks.append(callback)
+        return MockLoop.call_soon(loop, callback, *args)
+
+    loop.call_soon = call_soon
+    config = Config(app=app)
+    server_state = ServerState()
+    protocols = []
+    try:
+        for _ in range(3):
+            protocol = protocol_cls(
+                config=config, server_state=server_state, _loop=loop
+            )
+            protocol.connection_made(MockTransport())
+            protocol.data_received(SIMPLE_GET_REQUEST)
+            protocols.append(protocol)
+
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert len(callbacks) == 1
+        assert not server_state.pending_flush
+        for protocol in protocols:
+            assert protocol.transport.buffer.startswith(b"HTTP/1.1 200 OK")
+
+        body_ready.set_result(None)
+        loop.run_until_complete(asyncio.sleep(0.01))
+        for protocol in protocols:
+            assert protocol.transport.buffer.endswith(b"Hello, world\r\n0\r\n\r\n")
+    finally:
+        loop.close()
+        asyncio._set_running_loop(None)
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_scope_extensions_per_request(protocol_cls, event_loop):
+    extensions = []
+
+    async def app(scope, receive, send):
+        extensions.append(scope["extensions"])
+        scope["extensions"]["example"] = {}
+        response = Response("Hello, world", media_type="text/plain")
+        await response(scope, receive, send)
+
+    with get_connected_protocol_keep_alive(app, protocol_cls, event_loop) as protocol:
+        protocol.data_received(SIMPLE_GET_REQUEST)
+        protocol.loop.run_one()
+        protocol.data_received(SIMPLE_GET_REQUEST)
+        protocol.loop.run_one()
+        assert extensions[0] is not extensions[1]
+        assert extensions[1] == {"http.response.zerocopysend": {}, "example": {}}
+        assert protocol.transport.buffer.count(b"HTTP/1.1 200 OK") == 2
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_zerocopysend_fallback(protocol_cls, event_loop, tmp_path):
+    path = tmp_path / "example.txt"
+    path.write_bytes(b"0123456789")
+
+    async def app(scope, receive, send):
+        assert "http.response.zerocopysend" in scope["extensions"]
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        with open(path, "rb") as file:
+            file.seek(2)
+            await send(
+                {
+                    "type": "http.response.zerocopysend",
+                    "file": file,
+                    "count": 5,
+                    "more_body": True,
+                }
+            )
+            assert file.tell() == 7
+            await send(
+                {
+                    "type": "http.response.zerocopysend",
+                    "file": file,
+                    "offset": 0,
+                    "count": 2,
+                }
+            )
+
+    with get_connected_protocol(app, protocol_cls, event_loop) as protocol:
+        protocol.data_received(SIMPLE_GET_REQUEST)
+        protocol.loop.run_one()
+        assert b"HTTP/1.1 200 OK" in protocol.transport.buffer
+        assert protocol.transport.buffer.endswith(
+            b"\r\n\r\n5\r\n23456\r\n2\r\n01\r\n0\r\n\r\n"
+        )
+
+
 @pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
 def test_post_request(protocol_cls, event_loop):
     async def app(scope, receive, send):
@@ -297,7 +511,91 @@ def test_post_request(protocol_cls, event_loop):
         assert b'Body: {"hello": "world"}' in protocol.transport.buffer
 
 
+@pytest.mark.parametrize("zero_copy_body", [False, True])
+@pytest.mark.parametrize("stream_request_body", [False, True])
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_request_body_chunks(
+    stream_request_body, zero_copy_body, protocol_cls, event_loop
+):
+    received = []
+
+    async def app(scope, receive, send):
+        more_body = True
+        while more_body:
+            message = await receive()
+            received.append(message["body"])
+            more_body = message.get("more_body", False)
+        response = Response(b"", status_code=204)
+        await response(scope, receive, send)
+
+    head, body = SIMPLE_POST_REQUEST.split(b"\r\n\r\n", 1)
+    with get_connected_protocol(
+        app,
+        protocol_cls,
+        event_loop,
+        stream_request_body=stream_request_body,
+        zero_copy_body=zero_copy_body,
+    ) as protocol:
+        protocol.data_received(head + b"\r\n\r\n")
+        for i in range(0, len(body), 6):
+            protocol.data_received(body[i : i + 6])
+        protocol.loop.run_one()
+        assert b"HTTP/1.1 204 No Content" in protocol.transport.buffer
+        assert all(type(chunk) is bytes for chunk in received)
+        assert b"".join(received) == body
+        if stream_request_body:
+            assert received == [body[i : i + 6] for i in range(0, len(body), 6)]
+        else:
+            assert received == [body]
+
+
 # @pytest.mark.skip(reason="keep_alive")
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_receive_chunk_size(protocol_cls, event_loop):
+    chunks = []
+
+    async def app(scope, receive, send):
+        more_body = True
+        while more_body:
+            message = await receive()
+            if scope["method"] == "POST":
+                chunks.append(message["body"])
+            more_body = message["more_body"]
+        response = Response(b"Done", media_type="text/plain")
+        await response(scope, receive, send)
+
+    with get_connected_protocol_keep_alive(
+        app, protocol_cls, event_loop, receive_chunk_size=16
+    ) as protocol:
+        protocol.data_received(
+            b"POST / HTTP/1.1\r\nHost: example.org\r\nContent-Length: 40\r\n\r\n"
+            + b"x" * 40
+            + SIMPLE_GET_REQUEST
+        )
+        # Parsing stops at the first full chunk.
+        assert protocol.transport.read_paused
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert chunks == [b"x" * 16, b"x" * 16, b"x" * 8]
+        assert protocol.transport.buffer.count(b"HTTP/1.1 200 OK") == 2
+        assert not protocol.transport.read_paused
+        protocol.shutdown()
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_receive_chunk_size_body_ends_at_chunk(protocol_cls, event_loop):
+    with get_connected_protocol(
+        echo_body_app, protocol_cls, event_loop, receive_chunk_size=16
+    ) as protocol:
+        protocol.data_received(
+            b"POST / HTTP/1.1\r\nHost: example.org\r\nContent-Length: 32\r\n\r\n"
+            + b"x" * 32
+        )
+        assert protocol.transport.read_paused
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert b"HTTP/1.1 200 OK" in protocol.transport.buffer
+        assert protocol.transport.buffer.endswith(b"x" * 32)
+
+
 @pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
 def test_keepalive(protocol_cls, event_loop):
     app = Response(b"", status_code=204)
@@ -317,6 +615,383 @@ def test_keepalive(protocol_cls, event_loop):
         assert protocol.transport.is_closing()
 
 
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_asgi_task_created_on_request(protocol_cls, event_loop):
+    app = Response(b"", status_code=204)
+
+    with get_connected_protocol_keep_alive(app, protocol_cls, event_loop) as protocol:
+        assert not protocol.loop.tasks
+        protocol.data_received(SIMPLE_GET_REQUEST[:10])
+        assert not protocol.loop.tasks
+        protocol.data_received(SIMPLE_GET_REQUEST[10:])
+        assert len(protocol.loop.tasks) == 1
+        protocol.loop.run_one()
+        assert b"HTTP/1.1 204 No Content" in protocol.transport.buffer
+        assert not protocol.loop.tasks
+
+        protocol.transport.clear_buffer()
+        protocol.data_received(SIMPLE_GET_REQUEST)
+        assert len(protocol.loop.tasks) == 1
+        protocol.loop.run_one()
+        assert b"HTTP/1.1 204 No Content" in protocol.transport.buffer
+        assert not protocol.transport.is_closing()
+
+
+@pytest.mark.parametrize("pipeline_depth", [0, 1, 16])
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_pipelined_requests(pipeline_depth, protocol_cls, event_loop):
+    async def app(scope, receive, send):
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        content = b"Path: " + scope["path"].encode() + b" Body: " + body
+        response = Response(content, media_type="text/plain")
+        await response(scope, receive, send)
+
+    with get_connected_protocol_keep_alive(
+        app, protocol_cls, event_loop, pipeline_depth=pipeline_depth
+    ) as protocol:
+        protocol.data_received(PIPELINED_REQUESTS)
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        buffer = protocol.transport.buffer
+        assert buffer.count(b"HTTP/1.1 200 OK") == 3
+        assert (
+            buffer.index(b"Path: /one Body: ")
+            < buffer.index(b'Path: /two Body: {"hello": "world"}')
+            < buffer.index(b"Path: /three Body: ")
+        )
+        assert not protocol.transport.read_paused
+        assert not protocol.transport.is_closing()
+        protocol.shutdown()
+        protocol.loop.run_one()
+
+
+@pytest.mark.parametrize("write_batch_latency", [0, 0.01])
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_pipelined_responses_batched(write_batch_latency, protocol_cls, event_loop):
+    app = Response("Hello, world", media_type="text/plain")
+
+    with get_connected_protocol_keep_alive(
+        app, protocol_cls, event_loop, write_batch_latency=write_batch_latency
+    ) as protocol:
+        writes = []
+        transport = protocol.transport
+        transport.write = lambda data: writes.append(data)
+        transport.writelines = lambda lines: writes.append(b"".join(lines))
+        protocol.data_received(SIMPLE_GET_REQUEST * 3)
+        protocol.loop.run_until_complete(asyncio.sleep(0.05))
+        assert len(writes) == 1
+        assert writes[0].count(b"HTTP/1.1 200 OK") == 3
+        protocol.shutdown()
+        protocol.loop.run_one()
+
+
+@pytest.mark.parametrize("write_batch_latency", [0, 1])
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_batched_output_write_high_water(write_batch_latency, protocol_cls, event_loop):
+    written = []
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200})
+        await send({"type": "http.response.body", "body": b"x" * 10, "more_body": True})
+        written.append(len(protocol.transport.buffer))
+        await send({"type": "http.response.body", "body": b"x" * 20, "more_body": True})
+        written.append(len(protocol.transport.buffer))
+        await send({"type": "http.response.body", "body": b""})
+
+    with get_connected_protocol_keep_alive(
+        app,
+        protocol_cls,
+        event_loop,
+        write_batch_latency=write_batch_latency,
+        write_high_water=16,
+    ) as protocol:
+        protocol.data_received(SIMPLE_GET_REQUEST)
+        protocol.loop.run_one()
+        # Held back until the staged body passes the high-water mark.
+        assert written[0] == 0
+        assert written[1] > 30
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_pipeline_full_pauses_reading(protocol_cls, event_loop):
+    response_sent = asyncio.Event()
+
+    async def app(scope, receive, send):
+        if scope["path"] == "/one":
+            await response_sent.wait()
+        response = Response("Path: " + scope["path"], media_type="text/plain")
+        await response(scope, receive, send)
+
+    with get_connected_protocol_keep_alive(
+        app, protocol_cls, event_loop, pipeline_depth=0
+    ) as protocol:
+        protocol.data_received(PIPELINED_REQUESTS)
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert protocol.transport.buffer == b""
+        assert protocol.transport.read_paused
+        response_sent.set()
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert protocol.transport.buffer.count(b"HTTP/1.1 200 OK") == 3
+        assert not protocol.transport.read_paused
+        protocol.shutdown()
+        protocol.loop.run_one()
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_buffer_water_marks(protocol_cls, event_loop):
+    app = Response("Hello, world", media_type="text/plain")
+
+    with get_connected_protocol(
+        app,
+        protocol_cls,
+        event_loop,
+        read_high_water=16,
+        write_high_water=1024,
+        write_low_water=256,
+    ) as protocol:
+        assert protocol.transport.write_buffer_limits == (1024, 256)
+        protocol.data_received(SIMPLE_POST_REQUEST)
+        assert protocol.transport.read_paused
+        protocol.loop.run_one()
+        assert b"HTTP/1.1 200 OK" in protocol.transport.buffer
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_send_waits_while_write_paused(protocol_cls, event_loop):
+    app = Response("Hello, world", media_type="text/plain")
+
+    with get_connected_protocol(app, protocol_cls, event_loop) as protocol:
+        protocol.pause_writing()
+        protocol.data_received(SIMPLE_GET_REQUEST)
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert not protocol.transport.buffer
+        protocol.resume_writing()
+        protocol.loop.run_one()
+        assert b"HTTP/1.1 200 OK" in protocol.transport.buffer
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_read_memory_budget(protocol_cls, event_loop):
+    release = event_loop.create_future()
+
+    async def app(scope, receive, send):
+        await release
+        response = Response("Hello, world", media_type="text/plain")
+        await response(scope, receive, send)
+
+    loop = MockLoop(event_loop)
+    asyncio._set_running_loop(loop)
+    config = Config(app=app)
+    server_state = ServerState()
+    server_state.read_budget = budget = ReadBudget(100)
+    protocols = []
+    try:
+        for size in (80, 40):
+            protocol = protocol_cls(
+                config=config, server_state=server_state, _loop=loop
+            )
+            protocol.connection_made(MockTransport())
+            protocol.data_received(
+                b"POST / HTTP/1.1\r\nHost: example.org\r\n"
+                b"Content-Length: 200\r\n\r\n" + b"x" * size
+            )
+            protocols.append(protocol)
+        noisy, quiet = protocols
+
+        # Only the connection holding the most data stops reading.
+        assert budget.used == 120
+        assert noisy.transport.read_paused
+        assert not quiet.transport.read_paused
+
+        # And resumes once its data has been consumed.
+        message = loop.run_until_complete(noisy.receive())
+        assert message["body"] == b"x" * 80
+        assert budget.used == 40
+        assert not noisy.transport.read_paused
+
+        quiet.connection_lost(None)
+        assert budget.used == 0
+
+        release.set_result(None)
+        loop.run_until_complete(asyncio.sleep(0.01))
+    finally:
+        loop.close()
+        asyncio._set_running_loop(None)
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_read_memory_budget_keeps_high_water_pause(protocol_cls, event_loop):
+    release = event_loop.create_future()
+
+    async def app(scope, receive, send):
+        await release
+        response = Response("Hello, world", media_type="text/plain")
+        await response(scope, receive, send)
+
+    loop = MockLoop(event_loop)
+    asyncio._set_running_loop(loop)
+    config = Config(app=app, read_high_water=30)
+    server_state = ServerState()
+    server_state.read_budget = budget = ReadBudget(100)
+    protocols = []
+    try:
+        for size in (45, 40, 20):
+            protocol = protocol_cls(
+                config=config, server_state=server_state, _loop=loop
+            )
+            protocol.connection_made(MockTransport())
+            protocol.data_received(
+                b"POST / HTTP/1.1\r\nHost: example.org\r\n"
+                b"Content-Length: 200\r\n\r\n" + b"x" * size
+            )
+            protocols.append(protocol)
+        first, second, third = protocols
+        assert budget.used == 105
+
+        # Usage drops under half the budget, the first connection still
+        # holds more than its own high water mark.
+        loop.run_until_complete(second.receive())
+        loop.run_until_complete(third.receive())
+        assert budget.used == 45
+        assert first.transport.read_paused
+        assert not second.transport.read_paused
+
+        message = loop.run_until_complete(first.receive())
+        assert message["body"] == b"x" * 45
+        assert not first.transport.read_paused
+
+        for protocol in protocols:
+            protocol.connection_lost(None)
+        assert budget.used == 0
+
+        release.set_result(None)
+        loop.run_until_complete(asyncio.sleep(0.01))
+    finally:
+        loop.close()
+        asyncio._set_running_loop(None)
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_request_while_app_runs_after_response(protocol_cls, event_loop):
+    finished = []
+
+    async def app(scope, receive, send):
+        response = Response(scope["path"], media_type="text/plain")
+        await response(scope, receive, send)
+        await asyncio.sleep(0.05)
+        finished.append((scope["path"], len(scope["headers"])))
+
+    with get_connected_protocol_keep_alive(app, protocol_cls, event_loop) as protocol:
+        protocol.data_received(
+            b"\r\n".join([b"GET /one HTTP/1.1", b"Host: example.org", b"", b""])
+        )
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert protocol.transport.buffer.endswith(b"/one")
+
+        # The response is complete, the application isn't done yet.
+        protocol.data_received(
+            b"\r\n".join([b"GET /two HTTP/1.1", b"Host: example.org", b"", b""])
+        )
+        protocol.loop.run_until_complete(asyncio.sleep(0.06))
+        assert protocol.transport.buffer.endswith(b"/two")
+
+        # The application returns while the headers are still arriving.
+        protocol.data_received(b"GET /three HTTP/1.1\r\nHost: exa")
+        protocol.loop.run_until_complete(asyncio.sleep(0.1))
+        protocol.data_received(b"mple.org\r\nX-A: b\r\n\r\n")
+        protocol.loop.run_until_complete(asyncio.sleep(0.2))
+        assert finished == [("/one", 1), ("/two", 1), ("/three", 2)]
+        assert protocol.transport.buffer.count(b"HTTP/1.1 200 OK") == 3
+        assert protocol.transport.buffer.endswith(b"/three")
+        assert not protocol.transport.is_closing()
+        protocol.shutdown()
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_keepalive_timer_entries(protocol_cls, event_loop):
+    app = Response(b"", status_code=204)
+
+    loop = MockLoop(event_loop)
+    asyncio._set_running_loop(loop)
+    config = Config(app=app, timeout_keep_alive=1)
+    server_state = ServerState()
+    try:
+        protocol = protocol_cls(config=config, server_state=server_state, _loop=loop)
+        protocol.connection_made(MockTransport())
+        for _ in range(100):
+            protocol.data_received(SIMPLE_GET_REQUEST)
+            loop.run_until_complete(asyncio.sleep(0))
+        assert protocol.transport.buffer.count(b"HTTP/1.1 204 No Content") == 100
+        # One entry for the connection, not one per request.
+        assert len(server_state.timers) == 1
+
+        now = time.time() + 2
+        for connection_ref, generation in server_state.timers.expire(now):
+            connection_ref().on_timer(now, generation)
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert protocol.transport.is_closing()
+        assert len(server_state.timers) == 0
+    finally:
+        loop.close()
+        asyncio._set_running_loop(None)
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_released_to_pool_once_idle(protocol_cls, event_loop):
+    finish = event_loop.create_future()
+
+    async def app(scope, receive, send):
+        response = Response(b"", status_code=204)
+        await response(scope, receive, send)
+        await finish
+
+    loop = MockLoop(event_loop)
+    asyncio._set_running_loop(loop)
+    config = Config(app=app, timeout_keep_alive=1)
+    server_state = ServerState()
+    pool = server_state.protocol_pool = ProtocolPool(
+        partial(protocol_cls, config=config, server_state=server_state, _loop=loop)
+    )
+    try:
+        protocol = pool()
+        protocol.connection_made(MockTransport())
+        protocol.data_received(SIMPLE_GET_REQUEST)
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert protocol.transport.buffer.startswith(b"HTTP/1.1 204 No Content")
+        protocol.connection_lost(None)
+
+        # The application is still running.
+        assert pool.free == []
+        finish.set_result(None)
+        loop.run_until_complete(asyncio.sleep(0.01))
+
+        # The keep-alive timer is still pending.
+        assert pool.free == []
+        now = time.time() + 2
+        ((connection_ref, generation),) = server_state.timers.expire(now)
+        connection_ref().on_timer(now, generation)
+        assert pool.free == [protocol]
+
+        assert pool() is protocol
+        protocol.connection_made(MockTransport())
+        protocol.data_received(SIMPLE_GET_REQUEST)
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert protocol.transport.buffer.startswith(b"HTTP/1.1 204 No Content")
+
+        # A timer left over from the previous connection does nothing.
+        protocol.on_timer(now, generation)
+        assert not protocol.transport.is_closing()
+        protocol.on_timer(now, protocol.generation)
+        assert protocol.transport.is_closing()
+    finally:
+        loop.close()
+        asyncio._set_running_loop(None)
+
+
 @pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
 def test_close(protocol_cls, event_loop):
     app = Response(b"", status_code=204, headers={"connection": "close"})
@@ -328,6 +1003,42 @@ def test_close(protocol_cls, event_loop):
         assert protocol.transport.is_closing()
 
 
+@pytest.mark.parametrize("pipeline_depth", [0, 16])
+def test_buffered_protocol(pipeline_depth, event_loop):
+    async def app(scope, receive, send):
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        content = b"Path: " + scope["path"].encode() + b" Body: " + body
+        response = Response(content, media_type="text/plain")
+        await response(scope, receive, send)
+
+    with get_connected_protocol_keep_alive(
+        app, BufferedProtocol, event_loop, pipeline_depth=pipeline_depth
+    ) as protocol:
+        assert isinstance(protocol, asyncio.BufferedProtocol)
+        buffer = protocol.get_buffer(-1)
+        for i in range(0, len(PIPELINED_REQUESTS), 7):
+            chunk = PIPELINED_REQUESTS[i : i + 7]
+            assert protocol.get_buffer(-1) is buffer
+            buffer[: len(chunk)] = chunk
+            protocol.buffer_updated(len(chunk))
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        output = protocol.transport.buffer
+        assert output.count(b"HTTP/1.1 200 OK") == 3
+        assert (
+            output.index(b"Path: /one Body: ")
+            < output.index(b'Path: /two Body: {"hello": "world"}')
+            < output.index(b"Path: /three Body: ")
+        )
+        assert not protocol.transport.read_paused
+        protocol.shutdown()
+        protocol.loop.run_one()
+
+
 @pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
 def test_chunked_encoding(protocol_cls, event_loop):
     app = Response(
@@ -413,7 +1124,7 @@ def test_invalid_http(protocol_cls, event_loop):
     with get_connected_protocol(app, protocol_cls, event_loop) as protocol:
         protocol.data_received(b"x" * 100000)
         protocol.connection_lost(None)
-        protocol.loop.run_one()
+        assert not protocol.loop.tasks
         assert protocol.transport.is_closing()
 
 
@@ -520,6 +1231,23 @@ def test_value_returned(protocol_cls, event_loop):
         assert protocol.transport.is_closing()
 
 
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_value_returned_batched_output(protocol_cls, event_loop):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200})
+        await send({"type": "http.response.body", "body": b"Hello, world"})
+        return 123
+
+    with get_connected_protocol_keep_alive(
+        app, protocol_cls, event_loop, write_batch_latency=1
+    ) as protocol:
+        protocol.data_received(SIMPLE_GET_REQUEST)
+        protocol.loop.run_one()
+        assert b"HTTP/1.1 200 OK" in protocol.transport.buffer
+        assert protocol.transport.buffer.endswith(b"Hello, world\r\n0\r\n\r\n")
+        assert protocol.transport.is_closing()
+
+
 @pytest.mark.skip(reason="Another test implementation required")
 @pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
 def test_early_disconnect(protocol_cls, event_loop):
@@ -625,6 +1353,266 @@ def test_raw_path(protocol_cls, event_loop):
         assert b"Done" in protocol.transport.buffer
 
 
+@pytest.mark.parametrize(
+    "raw_path",
+    [
+        b"/caf%C3%A9",
+        b"/caf%c3%a9/caf%C3%A9",
+        b"/100%25",
+        b"/%zz%2",
+        b"/%E2%82x",
+        b"/%ff",
+        b"/trailing%",
+    ],
+)
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_percent_decoded_path(raw_path, protocol_cls, event_loop):
+    paths = []
+
+    async def app(scope, receive, send):
+        paths.append((scope["path"], scope["raw_path"], scope["query_string"]))
+        response = Response("Done", media_type="text/plain")
+        await response(scope, receive, send)
+
+    request = b"GET " + raw_path + b"?a=%20 HTTP/1.1\r\nHost: example.org\r\n\r\n"
+    expected = (unquote(raw_path.decode("ascii")), raw_path, b"a=%20")
+    with get_connected_protocol_keep_alive(app, protocol_cls, event_loop) as protocol:
+        # The second request is served from the URL cache.
+        for _ in range(2):
+            protocol.data_received(request)
+            protocol.loop.run_one()
+            assert b"Done" in protocol.transport.buffer
+            protocol.transport.clear_buffer()
+    assert paths == [expected, expected]
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_request_header_names(protocol_cls, event_loop):
+    headers = []
+
+    async def app(scope, receive, send):
+        headers.extend(scope["headers"])
+        response = Response("Done", media_type="text/plain")
+        await response(scope, receive, send)
+
+    with get_connected_protocol(app, protocol_cls, event_loop) as protocol:
+        protocol.data_received(
+            b"GET / HTTP/1.1\r\nHOST: example.org\r\nUser-Agent: test\r\n"
+            b"X-Custom-Header: 1\r\nContent-"
+        )
+        protocol.data_received(b"Type: text/plain\r\n\r\n")
+        protocol.loop.run_one()
+        assert b"Done" in protocol.transport.buffer
+
+    assert headers == [
+        (b"host", b"example.org"),
+        (b"user-agent", b"test"),
+        (b"x-custom-header", b"1"),
+        (b"content-type", b"text/plain"),
+    ]
+    common = {name: name for name in COMMON_HEADER_NAMES}
+    assert headers[0][0] is common[b"host"]
+    assert headers[1][0] is common[b"user-agent"]
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_request_headers_split_across_reads(protocol_cls, event_loop):
+    headers = []
+
+    async def app(scope, receive, send):
+        headers.extend(scope["headers"])
+        response = Response("Done", media_type="text/plain")
+        await response(scope, receive, send)
+
+    cookie = b"; ".join(b"key%d=%s" % (i, b"x" * 64) for i in range(64))
+    request = (
+        b"GET / HTTP/1.1\r\nHost: example.org\r\nX-Empty:\r\n"
+        b"Cookie: " + cookie + b"\r\n\r\n"
+    )
+    with get_connected_protocol(app, protocol_cls, event_loop) as protocol:
+        for i in range(0, len(request), 7):
+            protocol.data_received(request[i : i + 7])
+        protocol.loop.run_one()
+        assert b"Done" in protocol.transport.buffer
+
+    assert headers == [
+        (b"host", b"example.org"),
+        (b"x-empty", b""),
+        (b"cookie", cookie),
+    ]
+
+
+@pytest.mark.parametrize(
+    "request_data, status",
+    [
+        (b"GET /" + b"x" * 64 + b" HTTP/1.1\r\n\r\n", b"414 URI Too Long"),
+        (
+            b"GET / HTTP/1.1\r\nCookie: " + b"x" * 64 + b"\r\n\r\n",
+            b"431 Request Header Fields Too Large",
+        ),
+        (
+            b"GET / HTTP/1.1\r\n" + b"X-Header: 1\r\n" * 5 + b"\r\n",
+            b"431 Request Header Fields Too Large",
+        ),
+    ],
+)
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_request_limits(request_data, status, protocol_cls, event_loop):
+    app = Response("Hello, world", media_type="text/plain")
+
+    with get_connected_protocol(
+        app,
+        protocol_cls,
+        event_loop,
+        limit_request_line=64,
+        limit_request_headers=4,
+        limit_request_header_size=64,
+    ) as protocol:
+        # Split the request, the limits apply across reads.
+        protocol.data_received(request_data[:20])
+        protocol.data_received(request_data[20:])
+        assert not protocol.loop.tasks
+        assert protocol.transport.buffer.startswith(b"HTTP/1.1 " + status)
+        assert protocol.transport.is_closing()
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_request_within_limits(protocol_cls, event_loop):
+    app = Response("Hello, world", media_type="text/plain")
+
+    with get_connected_protocol(
+        app,
+        protocol_cls,
+        event_loop,
+        limit_request_line=64,
+        limit_request_headers=4,
+        limit_request_header_size=64,
+    ) as protocol:
+        protocol.data_received(
+            b"GET /"
+            + b"x" * 63
+            + b" HTTP/1.1\r\n"
+            + b"X-Header: "
+            + b"x" * 54
+            + b"\r\n" * 4
+            + b"\r\n"
+        )
+        protocol.loop.run_one()
+        assert b"HTTP/1.1 200 OK" in protocol.transport.buffer
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_request_trailers_dropped(protocol_cls, event_loop):
+    headers = []
+
+    async def app(scope, receive, send):
+        await echo_body_app(scope, receive, send)
+        headers.extend(scope["headers"])
+
+    with get_connected_protocol(
+        app, protocol_cls, event_loop, limit_request_headers=4
+    ) as protocol:
+        protocol.data_received(
+            b"POST / HTTP/1.1\r\n"
+            b"Host: example.org\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"Trailer: X-One, X-Two, X-Three\r\n\r\n"
+        )
+        # Neither counted against the header limit nor added to the scope.
+        protocol.data_received(
+            b"5\r\nhello\r\n0\r\n" b"X-One: 1\r\nX-Two: 2\r\nX-Three: 3\r\n\r\n"
+        )
+        protocol.loop.run_one()
+        assert b"HTTP/1.1 200 OK" in protocol.transport.buffer
+        assert protocol.transport.buffer.endswith(b"hello")
+        assert [name for name, _ in headers] == [
+            b"host",
+            b"transfer-encoding",
+            b"trailer",
+        ]
+
+
+async def echo_body_app(scope, receive, send):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    response = Response(b"Body: " + body, media_type="text/plain")
+    await response(scope, receive, send)
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_request_body_limit_content_length(protocol_cls, event_loop):
+    with get_connected_protocol_keep_alive(
+        echo_body_app, protocol_cls, event_loop, limit_request_body=24
+    ) as protocol:
+        protocol.data_received(
+            b"POST / HTTP/1.1\r\nHost: example.org\r\nContent-Length: 32\r\n\r\n"
+        )
+        # Answered before the body arrives and without running the app.
+        assert not protocol.loop.tasks
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert b"HTTP/1.1 413 " in protocol.transport.buffer
+        assert b"Payload Too Large" in protocol.transport.buffer
+
+        # The body is discarded and the connection kept alive.
+        protocol.transport.clear_buffer()
+        protocol.data_received(b"x" * 32 + SIMPLE_POST_REQUEST)
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert b"HTTP/1.1 200 OK" in protocol.transport.buffer
+        assert b'Body: {"hello": "world"}' in protocol.transport.buffer
+        assert not protocol.transport.is_closing()
+        protocol.shutdown()
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_request_body_limit_chunked(protocol_cls, event_loop):
+    with get_connected_protocol_keep_alive(
+        echo_body_app, protocol_cls, event_loop, limit_request_body=24
+    ) as protocol:
+        protocol.data_received(
+            b"POST / HTTP/1.1\r\nHost: example.org\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n10\r\n" + b"x" * 16 + b"\r\n"
+        )
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert not protocol.transport.buffer
+        protocol.data_received(b"10\r\n" + b"x" * 16 + b"\r\n")
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert b"HTTP/1.1 413 " in protocol.transport.buffer
+        assert b"Body:" not in protocol.transport.buffer
+
+        protocol.transport.clear_buffer()
+        protocol.data_received(b"10\r\n" + b"x" * 16 + b"\r\n0\r\n\r\n")
+        protocol.data_received(SIMPLE_POST_REQUEST)
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        assert b"HTTP/1.1 200 OK" in protocol.transport.buffer
+        assert b'Body: {"hello": "world"}' in protocol.transport.buffer
+        assert not protocol.transport.is_closing()
+        protocol.shutdown()
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_request_body_limit_pipelined(protocol_cls, event_loop):
+    with get_connected_protocol_keep_alive(
+        echo_body_app, protocol_cls, event_loop, limit_request_body=16
+    ) as protocol:
+        protocol.data_received(PIPELINED_REQUESTS)
+        protocol.loop.run_until_complete(asyncio.sleep(0.01))
+        buffer = protocol.transport.buffer
+        assert (
+            buffer.index(b"HTTP/1.1 200 OK")
+            < buffer.index(b"HTTP/1.1 413 ")
+            < buffer.rindex(b"HTTP/1.1 200 OK")
+        )
+        assert buffer.count(b"HTTP/1.1 200 OK") == 2
+        assert not protocol.transport.is_closing()
+        protocol.shutdown()
+
+
 @pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
 def test_max_concurrency(protocol_cls, event_loop):
     app = Response("Hello, world", media_type="text/plain")
@@ -634,7 +1622,7 @@ def test_max_concurrency(protocol_cls, event_loop):
     ) as protocol:
         protocol.data_received(SIMPLE_GET_REQUEST)
         protocol.connection_lost(None)
-        protocol.loop.run_one()
+        assert not protocol.loop.tasks
         assert b"HTTP/1.1 503 Service Unavailable" in protocol.transport.buffer
 
 
@@ -659,7 +1647,7 @@ def test_shutdown_during_idle(protocol_cls, event_loop):
     with get_connected_protocol(app, protocol_cls, event_loop) as protocol:
         protocol.shutdown()
         protocol.connection_lost(None)
-        protocol.loop.run_one()
+        assert not protocol.loop.tasks
         assert protocol.transport.buffer == b""
         assert protocol.transport.is_closing()
 
@@ -717,6 +1705,62 @@ def test_100_continue_not_sent_when_body_not_consumed(protocol_cls, event_loop):
         assert b"HTTP/1.1 204 No Content" in protocol.transport.buffer
 
 
+EXPECT_100_HEADERS = b"\r\n".join(
+    [
+        b"POST / HTTP/1.1",
+        b"Host: example.org",
+        b"Expect: 100-continue",
+        b"Content-Type: application/json",
+        b"Content-Length: 18",
+        b"",
+        b"",
+    ]
+)
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_expect_hook_accepts(protocol_cls, event_loop):
+    scopes = []
+
+    def expect_hook(scope):
+        scopes.append(scope)
+
+    with get_connected_protocol(
+        echo_body_app, protocol_cls, event_loop, expect_hook=expect_hook
+    ) as protocol:
+        protocol.data_received(EXPECT_100_HEADERS)
+        assert scopes[0]["path"] == "/"
+        assert protocol.transport.buffer == b"HTTP/1.1 100 Continue\r\n\r\n"
+        protocol.data_received(b'{"hello": "world"}')
+        protocol.loop.run_one()
+        assert protocol.transport.buffer.count(b"100 Continue") == 1
+        assert b"HTTP/1.1 200 OK" in protocol.transport.buffer
+        assert b'{"hello": "world"}' in protocol.transport.buffer
+
+
+@pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
+def test_expect_hook_rejects(protocol_cls, event_loop):
+    def expect_hook(scope):
+        return 417
+
+    with get_connected_protocol_keep_alive(
+        echo_body_app, protocol_cls, event_loop, expect_hook=expect_hook
+    ) as protocol:
+        protocol.data_received(EXPECT_100_HEADERS)
+        assert not protocol.loop.tasks
+        protocol.loop.run_until_complete(asyncio.sleep(0))
+        assert b"100 Continue" not in protocol.transport.buffer
+        assert b"HTTP/1.1 417 Expectation Failed" in protocol.transport.buffer
+        assert not protocol.transport.is_closing()
+
+        # The client may send the body anyway, the connection stays usable.
+        protocol.transport.clear_buffer()
+        protocol.data_received(b'{"hello": "world"}' + SIMPLE_GET_REQUEST)
+        protocol.loop.run_one()
+        assert b"HTTP/1.1 200 OK" in protocol.transport.buffer
+        assert b"hello" not in protocol.transport.buffer
+
+
 @pytest.mark.parametrize("protocol_cls", HTTP_PROTOCOLS)
 def test_unsupported_upgrade_request(protocol_cls, event_loop):
     app = Response("Hello, world", media_type="text/plain")
@@ -724,7 +1768,7 @@ def test_unsupported_upgrade_request(protocol_cls, event_loop):
     with get_connected_protocol(app, protocol_cls, event_loop, ws="none") as protocol:
         protocol.data_received(UPGRADE_REQUEST)
         protocol.connection_lost(None)
-        protocol.loop.run_one()
+        assert not protocol.loop.tasks
         assert b"HTTP/1.1 400 Bad Request" in protocol.transport.buffer
         assert b"Unsupported upgrade request." in protocol.transport.buffer
 
@@ -737,7 +1781,7 @@ def test_supported_upgrade_request(protocol_cls, event_loop):
         app, protocol_cls, event_loop, ws="wsproto"
     ) as protocol:
         protocol.data_received(UPGRADE_REQUEST)
-        protocol.loop.run_one()
+        assert not protocol.loop.tasks
         assert b"HTTP/1.1 426 " in protocol.transport.buffer
 
 
@@ -786,6 +1830,6 @@ def test_invalid_http_request(request_line, protocol_cls, caplog, event_loop):
     with get_connected_protocol(app, protocol_cls, event_loop) as protocol:
         protocol.data_received(request)
         protocol.connection_lost(None)
-        protocol.loop.run_one()
+        assert not protocol.loop.tasks
         assert not protocol.transport.buffer
         assert "Invalid HTTP request received." in caplog.messages
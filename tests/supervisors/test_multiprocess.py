@@ -1,13 +1,49 @@
+import gc
+import os
 import signal
+import socket
+import sys
+import time
+
+import pytest
 
 from esg import Config
 from esg.supervisors import Multiprocess
+from esg.supervisors.multiprocess import get_rss
 
 
-def run(sockets):
+def run(sockets, heartbeat=None):
     pass  # pragma: no cover
 
 
+def crash(sockets, heartbeat=None):
+    sys.exit(1)  # pragma: no cover
+
+
+def serve_once(sockets, heartbeat=None):
+    heartbeat.send_bytes(b"")  # pragma: no cover
+
+
+def serve_forever(sockets, heartbeat=None):
+    heartbeat.send_bytes(b"")  # pragma: no cover
+    time.sleep(60)  # pragma: no cover
+
+
+def hang(sockets, heartbeat=None):
+    time.sleep(60)  # pragma: no cover
+
+
+def hang_when_ready(sockets, heartbeat=None):
+    heartbeat.send_bytes(b"")  # pragma: no cover
+    time.sleep(60)  # pragma: no cover
+
+
+def wait_for_exit(supervisor):
+    for worker in supervisor.workers:
+        worker.process.join(10)
+    supervisor.supervise()
+
+
 def test_multiprocess_run():
     """
     A basic sanity check.
@@ -19,3 +55,223 @@ def test_multiprocess_run():
     supervisor = Multiprocess(config, target=run, sockets=[])
     supervisor.signal_handler(sig=signal.SIGINT, frame=None)
     supervisor.run()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="require fork")
+def test_multiprocess_run_preload():
+    config = Config(app="tests.test_main:app", workers=2, preload=True)
+    supervisor = Multiprocess(config, target=run, sockets=[])
+    supervisor.signal_handler(sig=signal.SIGINT, frame=None)
+    try:
+        supervisor.run()
+        assert config.loaded
+        assert gc.get_freeze_count() > 0
+        assert gc.isenabled()
+    finally:
+        gc.unfreeze()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="require fork")
+def test_multiprocess_run_preload_gc_disabled():
+    config = Config(app="tests.test_main:app", workers=2, preload=True)
+    supervisor = Multiprocess(config, target=run, sockets=[])
+    supervisor.signal_handler(sig=signal.SIGINT, frame=None)
+    gc.disable()
+    try:
+        supervisor.run()
+        assert not gc.isenabled()
+    finally:
+        gc.enable()
+        gc.unfreeze()
+
+
+def test_multiprocess_restart_crashed_worker_with_backoff():
+    config = Config(app=None, workers=1)
+    supervisor = Multiprocess(config, target=crash, sockets=[])
+    supervisor.startup()
+    try:
+        wait_for_exit(supervisor)
+        worker = supervisor.workers[0]
+        assert worker.process is None
+        assert worker.failures == 1
+        assert worker.restart_at > time.monotonic()
+
+        worker.restart_at = 0.0
+        supervisor.supervise()
+        assert worker.process is not None
+        wait_for_exit(supervisor)
+        assert worker.failures == 2
+        assert worker.restart_at - time.monotonic() > 0.5
+    finally:
+        supervisor.shutdown()
+
+
+def test_multiprocess_respawn_recycled_worker():
+    config = Config(app=None, workers=1)
+    supervisor = Multiprocess(config, target=serve_once, sockets=[])
+    supervisor.startup()
+    try:
+        process = supervisor.workers[0].process
+        wait_for_exit(supervisor)
+        worker = supervisor.workers[0]
+        assert worker.process is not None
+        assert worker.process is not process
+        assert worker.failures == 0
+    finally:
+        supervisor.shutdown()
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="require /proc")
+def test_get_rss():
+    assert get_rss(os.getpid()) > 0
+    assert get_rss(-1) is None
+
+
+def wait_for_reload(supervisor):
+    deadline = time.monotonic() + 10
+    while supervisor.reload_pending or supervisor.replacing is not None:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+        supervisor.supervise()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="require SIGHUP")
+def test_multiprocess_reload():
+    config = Config(app=None, workers=2)
+    supervisor = Multiprocess(config, target=serve_forever, sockets=[])
+    supervisor.startup()
+    try:
+        old_processes = list(supervisor.processes)
+        supervisor.signal_handler(sig=signal.SIGHUP, frame=None)
+        assert supervisor.should_reload
+        assert not supervisor.should_exit.is_set()
+
+        supervisor.reload()
+        # One worker at a time, without waiting for it.
+        supervisor.supervise()
+        assert supervisor.replacing is supervisor.workers[0]
+        assert list(supervisor.reload_pending) == supervisor.workers[1:]
+        assert supervisor.retiring == []
+
+        wait_for_reload(supervisor)
+        assert all(worker.ready for worker in supervisor.workers)
+        assert set(supervisor.processes).isdisjoint(old_processes)
+        assert set(supervisor.retiring) <= set(old_processes)
+    finally:
+        supervisor.shutdown()
+    assert all(process.exitcode == -signal.SIGTERM for process in old_processes)
+
+
+def test_multiprocess_reload_aborted():
+    config = Config(app=None, workers=2, timeout_worker_heartbeat=1)
+    supervisor = Multiprocess(config, target=hang, sockets=[])
+    supervisor.startup()
+    try:
+        processes = list(supervisor.processes)
+        supervisor.reload()
+        wait_for_reload(supervisor)
+        assert supervisor.processes == processes
+        assert all(process.exitcode is None for process in processes)
+    finally:
+        supervisor.shutdown()
+
+
+def test_multiprocess_shutdown_during_reload():
+    config = Config(app=None, workers=1)
+    supervisor = Multiprocess(config, target=hang, sockets=[])
+    supervisor.startup()
+    process = supervisor.workers[0].process
+    supervisor.reload()
+    supervisor.supervise()
+    replacement = supervisor.workers[0].process
+    assert replacement is not process
+
+    supervisor.shutdown()
+    assert supervisor.workers[0].process is process
+    assert process.exitcode is not None
+    assert replacement.exitcode is not None
+
+
+def test_multiprocess_heartbeat_timeout():
+    config = Config(app=None, workers=2, timeout_worker_heartbeat=1)
+    supervisor = Multiprocess(config, target=hang, sockets=[])
+    supervisor.startup()
+    starting = supervisor.workers[0]
+    try:
+        # Still starting, the timeout only applies once the worker is ready.
+        time.sleep(1.5)
+        supervisor.supervise()
+        assert starting.process.exitcode is None
+
+        hung = supervisor.workers[1]
+        hung.process.terminate()
+        hung.process.join()
+        # Respawned after the crash backoff, as a worker that gets ready.
+        supervisor.target = hang_when_ready
+        for _ in range(50):
+            supervisor.supervise()
+            if hung.ready:
+                break
+            time.sleep(0.1)
+        assert hung.ready
+        process = hung.process
+        time.sleep(1.5)
+        supervisor.supervise()
+        process.join(10)
+        assert process.exitcode == -signal.SIGKILL
+        assert starting.process.exitcode is None
+    finally:
+        supervisor.shutdown()
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="require SO_REUSEPORT on Linux")
+def test_multiprocess_reuse_port_sockets():
+    config = Config(app=None, workers=2, port=0, reuse_port=True, reuse_port_cbpf=True)
+    sock = config.bind_socket()
+    supervisor = Multiprocess(config, target=run, sockets=[sock])
+    sockets = supervisor.listen_reuse_port([None, None])
+    try:
+        assert [len(worker_sockets) for worker_sockets in sockets] == [1, 1]
+        port = sock.getsockname()[1]
+        assert all(s.getsockname()[1] == port for (s,) in sockets)
+
+        # Received on CPU 0, handed to the first worker's socket.
+        affinity = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, {0})
+        try:
+            with socket.create_connection(("127.0.0.1", port)):
+                pass
+        finally:
+            os.sched_setaffinity(0, affinity)
+        first, second = (s for (s,) in sockets)
+        first.settimeout(1)
+        first.accept()[0].close()
+        second.setblocking(False)
+        with pytest.raises(BlockingIOError):
+            second.accept()
+    finally:
+        for (s,) in sockets:
+            s.close()
+        sock.close()
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="require SO_REUSEPORT on Linux")
+def test_multiprocess_reuse_port_crashed_worker_detached():
+    config = Config(app=None, workers=1, port=0, reuse_port=True)
+    sock = config.bind_socket()
+    supervisor = Multiprocess(config, target=crash, sockets=[sock])
+    supervisor.startup()
+    try:
+        wait_for_exit(supervisor)
+        (group,) = supervisor.groups
+        assert group.order == []
+        # Refused during the backoff, rather than left in the socket's queue.
+        with pytest.raises(ConnectionRefusedError):
+            socket.create_connection(sock.getsockname(), timeout=1)
+
+        supervisor.workers[0].restart_at = 0.0
+        supervisor.supervise()
+        assert group.order == [0]
+    finally:
+        supervisor.shutdown()
+        sock.close()
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+import pytest
+
+from esg.affinity import get_numa_nodes, get_worker_cpus, parse_cpu_list
+
+
+def test_parse_cpu_list() -> None:
+    assert parse_cpu_list("0,2,4-6\n") == {0, 2, 4, 5, 6}
+    assert parse_cpu_list("") == set()
+
+
+def test_get_numa_nodes(tmp_path: Path) -> None:
+    for name, cpulist in [("node1", "2-3\n"), ("node0", "0-1\n"), ("node10", "")]:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "cpulist").write_text(cpulist)
+    (tmp_path / "possible").write_text("0-1\n")
+
+    assert get_numa_nodes(tmp_path) == [{0, 1}, {2, 3}]
+    assert get_numa_nodes(tmp_path / "missing") == []
+
+
+def test_get_worker_cpus() -> None:
+    nodes = [{0, 1, 4, 5}, {2, 3, 6, 7}]
+    available = set(range(8))
+
+    assert get_worker_cpus("auto", 5, available, nodes) == [
+        {0},
+        {1},
+        {4},
+        {5},
+        {2},
+    ]
+    assert get_worker_cpus("auto", 3, {1, 2, 3}, []) == [{1}, {2}, {3}]
+    assert get_worker_cpus("numa", 3, available - {0, 1}, nodes) == [
+        {4, 5},
+        {2, 3, 6, 7},
+        {4, 5},
+    ]
+    assert get_worker_cpus("0-1;6", 3, available, nodes) == [{0, 1}, {6}, {0, 1}]
+
+
+@pytest.mark.parametrize("spec", ["8", ";", "x"])
+def test_get_worker_cpus_invalid(spec: str) -> None:
+    with pytest.raises(ValueError):
+        get_worker_cpus(spec, 2, set(range(8)), [])
@@ -15,10 +15,11 @@ from asgiref.typing import ASGIApplication, ASGIReceiveCallable, ASGISendCallabl
 from pytest_mock import MockerFixture
 
 from esg._types import Environ, StartResponse
-from esg.config import LOGGING_CONFIG, Config
+from esg.config import LOGGING_CONFIG, Config, HTTPProtocolType
 from esg.middleware.debug import DebugMiddleware
 from esg.middleware.proxy_headers import ProxyHeadersMiddleware
 from esg.middleware.wsgi import WSGIMiddleware
+from esg.protocols.http.protocol import BufferedProtocol, Protocol
 from tests.utils import as_cwd
 
 
@@ -240,6 +241,17 @@ def test_wsgi_app() -> None:
     assert config.asgi_version == "3.0"
 
 
+@pytest.mark.parametrize(
+    "http, expected",
+    [("auto", Protocol), ("llhttp", Protocol), ("buffered", BufferedProtocol)],
+)
+def test_http_protocol_class(http: HTTPProtocolType, expected: type) -> None:
+    config = Config(app=asgi_app, http=http)
+    config.load()
+
+    assert config.http_protocol_class is expected
+
+
 def test_proxy_headers() -> None:
     config = Config(app=asgi_app)
     config.load()
@@ -293,6 +305,28 @@ def test_app_factory(caplog: pytest.LogCaptureFixture) -> None:
         config.load()
 
 
+@pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="require CPU affinity")
+@pytest.mark.parametrize(
+    "cpu_affinity, message",
+    [
+        ("x", "Invalid cpu_affinity: 'x'"),
+        (";", "Invalid cpu_affinity: ';'"),
+        ("100000", "Invalid CPU list in cpu_affinity: '100000'"),
+    ],
+)
+def test_invalid_cpu_affinity(
+    cpu_affinity: str, message: str, caplog: pytest.LogCaptureFixture
+) -> None:
+    with pytest.raises(SystemExit):
+        Config(app=asgi_app, cpu_affinity=cpu_affinity)
+    error_messages = [
+        record.message
+        for record in caplog.records
+        if record.name == "esg.error" and record.levelname == "ERROR"
+    ]
+    assert error_messages == [message]
+
+
 def test_socket_bind() -> None:
     config = Config(app=asgi_app)
     config.load()
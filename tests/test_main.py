@@ -1,3 +1,4 @@
+import sys
 from logging import WARNING
 
 import httpx
@@ -5,6 +6,7 @@ import pytest
 
 from esg.config import Config
 from esg.main import run
+from esg.reuseport import listen_group
 from tests.utils import run_server
 
 
@@ -46,6 +48,26 @@ async def test_run(host, url):
     assert response.status_code == 204
 
 
+@pytest.mark.asyncio
+async def test_zerocopysend(tmp_path):
+    path = tmp_path / "example.txt"
+    path.write_bytes(b"Hello, world!" * 10000)
+
+    async def app(scope, receive, send):
+        assert "http.response.zerocopysend" in scope["extensions"]
+        headers = [(b"content-length", b"130000")]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        with open(path, "rb") as file:
+            await send({"type": "http.response.zerocopysend", "file": file})
+
+    config = Config(app=app, loop="asyncio", limit_max_requests=1)
+    async with run_server(config):
+        async with httpx.AsyncClient() as client:
+            response = await client.get("http://127.0.0.1:8000")
+    assert response.status_code == 200
+    assert response.content == b"Hello, world!" * 10000
+
+
 @pytest.mark.asyncio
 async def test_run_multiprocess():
     config = Config(app=app, loop="asyncio", workers=2, limit_max_requests=1)
@@ -55,6 +77,31 @@ async def test_run_multiprocess():
     assert response.status_code == 204
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.platform != "linux", reason="require SO_REUSEPORT on Linux")
+async def test_run_reuse_port():
+    config = Config(
+        app=app,
+        loop="asyncio",
+        workers=2,
+        reuse_port=True,
+        reuse_port_cbpf=True,
+        limit_max_requests=1,
+    )
+    sock = config.bind_socket()
+    # Two workers, each listening on a socket of its own next to the parent's.
+    first_sock, second_sock = listen_group(sock, 2, config.backlog)
+    try:
+        async with run_server(config, sockets=[first_sock]):
+            async with run_server(config, sockets=[second_sock]):
+                async with httpx.AsyncClient() as client:
+                    response = await client.get("http://127.0.0.1:8000")
+    finally:
+        for s in (first_sock, second_sock, sock):
+            s.close()
+    assert response.status_code == 204
+
+
 @pytest.mark.asyncio
 async def test_run_reload():
     config = Config(app=app, loop="asyncio", reload=True, limit_max_requests=1)
@@ -0,0 +1,131 @@
+import os
+import socket
+import sys
+
+import pytest
+
+from esg.affinity import get_worker_cpus
+from esg.config import Config
+from esg.reuseport import (
+    ReuseportGroup,
+    attach_cpu_program,
+    get_cpu_sockets,
+    listen_group,
+)
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="require SO_REUSEPORT on Linux")
+def test_attach_cpu_program() -> None:
+    listeners = []
+    for _ in range(2):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("127.0.0.1", listeners[0].getsockname()[1] if listeners else 0))
+        sock.listen()
+        attach_cpu_program(sock, 2)
+        listeners.append(sock)
+
+    port = listeners[0].getsockname()[1]
+    with socket.create_connection(("127.0.0.1", port)):
+        pass
+    accepted = 0
+    for sock in listeners:
+        sock.setblocking(False)
+        try:
+            sock.accept()[0].close()
+            accepted += 1
+        except BlockingIOError:
+            pass
+        sock.close()
+    assert accepted == 1
+
+
+@pytest.mark.parametrize(
+    "spec, workers",
+    [("auto", 8), ("auto", 3), ("numa", 4), ("numa", 3), ("0-3;2-5", 2)],
+)
+def test_cpu_sockets_follow_worker_cpus(spec: str, workers: int) -> None:
+    nodes = [{0, 1, 4, 5}, {2, 3, 6, 7}]
+    worker_cpus = get_worker_cpus(spec, workers, set(range(8)), nodes)
+    cpu_sockets = get_cpu_sockets(worker_cpus)
+
+    # Connections go to a worker pinned to the CPU that received them.
+    assert set(cpu_sockets) == set().union(*worker_cpus)
+    for cpu, idx in cpu_sockets.items():
+        assert cpu in worker_cpus[idx]
+    # Workers pinned to the same CPUs all get some of them.
+    assert set(cpu_sockets.values()) == set(range(workers))
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="require SO_REUSEPORT on Linux")
+def test_attach_cpu_program_cpu_sockets() -> None:
+    reserved = socket.socket()
+    reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    reserved.bind(("127.0.0.1", 0))
+    listeners = listen_group(reserved, 2, 8)
+    # Connections received by CPU 0 go to the second socket.
+    attach_cpu_program(listeners[0], 2, {0: 1})
+
+    affinity = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, {0})
+    try:
+        with socket.create_connection(reserved.getsockname()):
+            pass
+    finally:
+        os.sched_setaffinity(0, affinity)
+    first, second = listeners
+    second.settimeout(1)
+    second.accept()[0].close()
+    first.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        first.accept()
+    for sock in listeners + [reserved]:
+        sock.close()
+
+
+def connect_on_cpu_0(address) -> None:
+    affinity = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, {0})
+    try:
+        with socket.create_connection(address):
+            pass
+    finally:
+        os.sched_setaffinity(0, affinity)
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="require SO_REUSEPORT on Linux")
+def test_reuseport_group_detach_rejoin() -> None:
+    reserved = socket.socket()
+    reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    reserved.bind(("127.0.0.1", 0))
+    group = ReuseportGroup(reserved, 2, 8, cpu_program=True, cpu_sockets={0: 0})
+    first, second = group.sockets
+    first.setblocking(False)
+    second.settimeout(1)
+    try:
+        # Connections received by CPU 0 go to the other socket meanwhile.
+        group.detach(0)
+        assert group.order == [1]
+        connect_on_cpu_0(reserved.getsockname())
+        second.accept()[0].close()
+
+        # Back at the end of the group, still getting CPU 0's connections.
+        group.rejoin(0)
+        assert group.order == [1, 0]
+        connect_on_cpu_0(reserved.getsockname())
+        first.settimeout(1)
+        first.accept()[0].close()
+        second.setblocking(False)
+        with pytest.raises(BlockingIOError):
+            second.accept()
+    finally:
+        group.close()
+        reserved.close()
+
+
+def test_reuse_port_ignored_for_unix_sockets(tmp_path) -> None:
+    config = Config(
+        app=None, uds=str(tmp_path / "esg.sock"), reuse_port=True, reuse_port_cbpf=True
+    )
+    assert not config.reuse_port
+    assert not config.reuse_port_cbpf
@@ -0,0 +1,61 @@
+import asyncio
+import multiprocessing
+from functools import partial
+
+from esg.config import Config
+from esg.protocols.http.protocol import Protocol
+from esg.server import ProtocolPool, Server, ServerState
+
+
+async def app(scope, receive, send):
+    pass  # pragma: no cover
+
+
+def test_protocol_pool_reuses_released_instances() -> None:
+    loop = asyncio.new_event_loop()
+    server_state = ServerState()
+    config = Config(app=app)
+    pool = ProtocolPool(
+        partial(Protocol, config=config, server_state=server_state, _loop=loop),
+        size=1,
+    )
+
+    protocol = pool()
+    other = pool()
+    assert protocol is not other
+
+    pool.release(protocol)
+    pool.release(other)
+    assert pool.free == [protocol]
+
+    generation = protocol.generation
+    assert pool() is protocol
+    assert protocol.generation == generation + 1
+    assert pool.free == []
+    loop.close()
+
+
+def test_shutdown_sends_heartbeats_while_draining() -> None:
+    class Connection:
+        def shutdown(self) -> None:
+            pass
+
+    loop = asyncio.new_event_loop()
+    config = Config(app=app, lifespan="off")
+    config.load()
+    server = Server(config=config)
+    server.servers = []
+    server.lifespan = config.lifespan_class(config)
+    reader, server.heartbeat = multiprocessing.Pipe(duplex=False)
+
+    connection = Connection()
+    server.server_state.connections.add(connection)
+    loop.call_later(0.5, server.server_state.connections.discard, connection)
+    loop.run_until_complete(server.shutdown())
+    loop.close()
+
+    heartbeats = 0
+    while reader.poll():
+        reader.recv_bytes()
+        heartbeats += 1
+    assert heartbeats >= 3
@@ -0,0 +1,39 @@
+from esg.timer_wheel import TimerWheel
+
+
+def test_expire_due_entries_only() -> None:
+    timers = TimerWheel(resolution=0.1)
+    timers.schedule("a", 10.0)
+    timers.schedule("b", 10.25)
+    timers.schedule("c", 12.0)
+    assert len(timers) == 3
+
+    assert timers.expire(9.95) == []
+    assert timers.expire(10.15) == ["a"]
+    assert timers.expire(10.15) == []
+    assert timers.expire(11.0) == ["b"]
+    assert len(timers) == 1
+    assert timers.expire(100.0) == ["c"]
+    assert len(timers) == 0
+
+
+def test_schedule_in_the_past() -> None:
+    timers = TimerWheel(resolution=0.1)
+    assert timers.expire(10.0) == []
+
+    timers.schedule("a", 5.0)
+    assert timers.expire(10.0) == []
+    assert timers.expire(10.25) == ["a"]
+
+
+def test_expired_entries_have_reached_their_deadline() -> None:
+    timers = TimerWheel(resolution=0.1)
+    deadlines = [10 + i / 100 for i in range(100)]
+    for deadline in deadlines:
+        timers.schedule(deadline, deadline)
+
+    now = 9.0
+    while len(timers):
+        now += 0.1
+        for deadline in timers.expire(now):
+            assert deadline < now